@@ -24,9 +24,9 @@ if ETSConfig.toolkit == "wx":
     from traitsui.wx import constants
     constants.WindowColor = constants.wx.NullColor
 
-import optparse, logging, urlparse
+import optparse, logging, functools
 
-#from .capture import BaseCapture, DummyCapture
+from .capture import open_capture, DarkLibrary
 from .process import Process
 from .bullseye import Bullseye
 
@@ -39,7 +39,28 @@ def main():
     p.add_option("-s", "--save", default=None,
             help="save images accordint to strftime() "
                 "format string (e.g. 'beam_%Y%m%d%H%M%S.npz'), "
-                "compressed npz format [%default]")
+                "see --codec [%default]")
+    p.add_option("-z", "--codec", default="npz",
+            choices=["npz", "npz-stored", "npy"],
+            help="format of the saved images: compressed npz, "
+                "uncompressed npz or npy, uncompressed is much faster "
+                "[%default]")
+    p.add_option("-B", "--save-block", action="store_true", default=False,
+            help="wait for the image writer instead of dropping images "
+                "if it falls behind [%default]")
+    p.add_option("-a", "--server", action="store_true", default=False,
+            help="run the camera in a separate acquisition process "
+                "that hands frames over in shared memory [%default]")
+    p.add_option("-D", "--darks", default=None,
+            help="keep the dark images in this directory, by shutter "
+                "and gain [%default]")
+    p.add_option("-m", "--maxmem", type="int", default=None,
+            help="bound the temporary memory of the beam projections "
+                "to this many MB, useful for large sensors [%default]")
+    p.add_option("-w", "--workers", type="int", default=0,
+            help="process frames in this many threads, results are "
+                "delivered in order and the oldest waiting frames are "
+                "dropped if the workers fall behind [%default]")
     p.add_option("-l", "--log",
             help="log output file [stderr]")
     p.add_option("-d", "--debug", default="info",
@@ -49,51 +70,25 @@ def main():
     logging.basicConfig(filename=opts.log,
             level=getattr(logging, opts.debug.upper()),
             format='%(asctime)s %(levelname)s %(message)s')
-    scheme, loc, path, query, frag = urlparse.urlsplit(opts.camera)
-    if scheme == "dc1394":
-        from .dc1394_capture import DC1394Capture
-        if loc == "guid":
-            cam = DC1394Capture(long(path[1:], base=16))
-    elif scheme == "fc2":
-        from .flycapture2_capture import Fc2Capture
-        if loc == "index":
-            cam = Fc2Capture(int(path[1:]))
-    elif scheme == "opencv":
-        from .opencv_capture import OpenCVCapture
-        if loc == "index":
-            cam = OpenCVCapture(int(path[1:]))
-    elif scheme == "replay":
-        from .replay_capture import ReplayCapture
-        if loc == "glob":
-            cam = ReplayCapture(path[1:])
-    elif scheme == "none":
-        from .capture import DummyCapture
-        cam = DummyCapture()
-    elif scheme == "any":
-        try:
-            from .dc1394_capture import DC1394Capture
-            cam = DC1394Capture()
-        except Exception, e:
-            logging.debug("dc1394 error: %s", e)
-            try:
-                from .flycapture2_capture import Fc2Capture
-                cam = Fc2Capture()
-            except Exception, e:
-                logging.debug("flycapture2 error: %s", e)
-                try:
-                    from .opencv_capture import OpenCVCapture
-                    cam = OpenCVCapture()
-                except Exception, e:
-                    logging.debug("opencv error: %s", e)
-                    from .capture import DummyCapture
-                    cam = DummyCapture()
+    if opts.server:
+        from .shared_capture import SharedCapture
+        cam = SharedCapture(functools.partial(open_capture, opts.camera))
+    else:
+        cam = open_capture(opts.camera)
     logging.debug("running with capture device: %s", cam)
     if opts.save:
-        cam.save_format = opts.save
-    proc = Process(capture=cam)
+        cam.trait_set(save_codec=opts.codec, save_block=opts.save_block,
+                save_format=opts.save)
+    if opts.darks:
+        cam.darks = DarkLibrary(opts.darks)
+    proc = Process(capture=cam, energy_levels=[.86, .95, .99])
+    if opts.maxmem:
+        proc.maxmem = opts.maxmem<<20
+    proc.workers = opts.workers
     bull = Bullseye(process=proc)
     bull.configure_traits()
     bull.close()
+    cam.close()
 
 if __name__ == "__main__":
     main()
@@ -17,24 +17,44 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from traits.api import (HasTraits, Enum, Bool,
-        Instance, Delegate, on_trait_change)
+from traits.api import (HasTraits, Enum, Bool, Float, Range, Any,
+        Instance, Delegate, Event, on_trait_change)
 
 from traitsui.api import (View, Item, UItem,
         HGroup, VGroup, DefaultOverride)
 
 from chaco.api import (Plot, ArrayPlotData, color_map_name_dict,
-        GridPlotContainer, VPlotContainer, PlotLabel)
+        GridPlotContainer, VPlotContainer, PlotLabel, DataRange1D)
 from chaco.tools.api import (ZoomTool, SaveTool, ImageInspectorTool,
         ImageInspectorOverlay, PanTool)
 
 from enable.component_editor import ComponentEditor
 
+import numpy as np
+import time
+from threading import Lock
+
 from .process import Process
 
 slider_editor = DefaultOverride(mode="slider")
 
 
+class FrameInspectorTool(ImageInspectorTool):
+    """Reports the full resolution pixel of the last frame under the
+    cursor, the displayed image may be decimated."""
+    process = Instance(Process)
+
+    def normal_mouse_move(self, event):
+        x, y = self.component.map_data((event.x, event.y))
+        v = self.process.pixel(x, y)
+        if v is None:
+            self.new_value = None
+        else:
+            i, j, d = v
+            self.new_value = dict(indices=(i, j), data_value=d)
+        self.last_mouse_position = (event.x, event.y)
+
+
 class Bullseye(HasTraits):
     plots = Instance(GridPlotContainer)
     abplots = Instance(VPlotContainer)
@@ -49,7 +69,13 @@ class Bullseye(HasTraits):
     colormap = Enum("gray", "jet", "hot", "prism")
     invert = Bool(True)
 
+    refresh = Range(1., 100., 25.) # maximum display updates per second
+    lag = Float # ms from capture to display of the last painted frame
+    frame = Event # a new frame is in the mailbox
+    _mailbox = Any # latest analyze() result not yet painted
+
     label = None
+    subscription = None
     gridm = None
     grid = None
 
@@ -101,7 +127,10 @@ class Bullseye(HasTraits):
                 tooltip="frames per second to attempt, may be limited by "
                 "shutter time and processing speed"),
             Item("object.process.capture.average",
-                tooltip="number of subsequent images to boxcar average"),
+                tooltip="number of subsequent images to boxcar average "
+                "or time constant of the exponential average"),
+            Item("object.process.capture.average_mode", label="Mode",
+                tooltip="boxcar or exponential moving average (ema)"),
             Item("object.process.background",
                 tooltip="background intensity percentile to subtract "
                 "from image"),
@@ -118,12 +147,35 @@ class Bullseye(HasTraits):
             Item("object.process.track",
                 tooltip="adjust the region of interest to track the "
                 "beam center, the size is not adjusted"),
+            Item("object.process.elliptical",
+                tooltip="use an elliptical instead of a circular "
+                "include region"),
+            Item("object.process.adaptive",
+                tooltip="stop cropping once the moments converge and "
+                "start from the previous crop"),
+            Item("object.process.pyramid",
+                tooltip="find the first crop on a block summed frame, "
+                "2x to 8x depending on the sensor size"),
+            Item("object.process.sparse",
+                tooltip="only process the pixels above the background "
+                "percentile, for small beams on large sensors"),
             Item("object.process.capture.dark",
-                tooltip="capture a dark image and subtract it from "
-                "subsequent images, reset if gain or shutter change"),
+                tooltip="subtract the dark image for the current shutter "
+                "and gain, takes it first if there is none"),
+            UItem("object.process.capture.take_dark",
+                tooltip="take a new dark image for the current shutter "
+                "and gain, averaged over several frames"),
+            Item("object.process.capture.dark_missing", style="readonly",
+                tooltip="there is no dark image for the current shutter "
+                "and gain, the one with the closest shutter is used"),
         ), HGroup(
             UItem("colormap", tooltip="image colormap"),
             Item("invert", tooltip="invert the colormap"),
+            Item("refresh", tooltip="maximum display updates per "
+                "second, frames in between are not displayed"),
+            Item("lag", style="readonly", format_str=u"%.0f ms",
+                tooltip="time from capture to display of the last "
+                "displayed frame"),
         ), UItem("abplots", editor=ComponentEditor(),
                 width=-200, height=-300, resizable=False,
                 tooltip="line sums (red), moments (blue) and "
@@ -142,12 +194,41 @@ class Bullseye(HasTraits):
         super(Bullseye, self).__init__(**k)
         self.data = ArrayPlotData()
         self.process.initialize()
+        self.set_lut()
         self.setup_plots()
         self.update_data()
         self.populate_plots()
 
-        self.on_trait_change(self.update_data, "process.new_data",
+        self.lock = Lock()
+        self.on_trait_change(self.update_frame, "frame",
                 dispatch="fast_ui")
+        self.subscription = self.process.subscribe(self._post,
+                self.refresh)
+
+    def _post(self, r):
+        # latest wins: only the first frame into an empty mailbox posts
+        # an ui event, later ones replace it until it is painted
+        with self.lock:
+            empty = self._mailbox is None
+            self._mailbox = r
+        if empty:
+            self.frame = True
+
+    def update_frame(self):
+        with self.lock:
+            r, self._mailbox = self._mailbox, None
+        if r is None:
+            return
+        self.update_data(r["data"])
+        self.lag = (time.time()-r["time"])*1e3
+
+    @on_trait_change("refresh")
+    def _resubscribe(self):
+        if self.subscription is None: # not yet set up
+            return
+        self.process.unsubscribe(self.subscription)
+        self.subscription = self.process.subscribe(self._post,
+                self.refresh)
 
     def setup_plots(self):
         self.screen = Plot(self.data,
@@ -229,15 +310,14 @@ class Bullseye(HasTraits):
         self.abplots.add(self.bsum, self.asum)
 
     def populate_plots(self):
+        # precolored by the process, see set_lut()
         self.screenplot = self.screen.img_plot("img",
                 xbounds="xbounds", ybounds="ybounds",
                 interpolation="nearest",
-                colormap=color_map_name_dict[self.colormap],
                 )[0]
-        self.set_invert()
         self.grid = self.screenplot.index
         self.gridm = self.screenplot.index_mapper
-        t = ImageInspectorTool(self.screenplot)
+        t = FrameInspectorTool(self.screenplot, process=self.process)
         self.screen.tools.append(t)
         self.screenplot.overlays.append(ImageInspectorOverlay(
             component=self.screenplot, image_inspector=t,
@@ -268,24 +348,31 @@ class Bullseye(HasTraits):
 
     def close(self):
         self.process.active = False
-
-    @on_trait_change("colormap")
-    def set_colormap(self):
-        p = self.screenplot
-        m = color_map_name_dict[self.colormap]
-        p.color_mapper = m(p.value_range)
-        self.set_invert()
-        p.request_redraw()
-
-    @on_trait_change("invert")
-    def set_invert(self):
-        p = self.screenplot
+        if self.subscription is not None: # closed twice, app and __del__
+            self.process.unsubscribe(self.subscription)
+            self.subscription = None
+
+    @on_trait_change("screen.bounds")
+    def set_viewport(self):
+        # the frame is cropped to the visible region (roi), the display
+        # image only needs to match the screen size
+        w, h = self.screen.bounds
+        self.process.viewport = (int(w), int(h))
+
+    @on_trait_change("colormap, invert")
+    def set_lut(self):
+        maxval = self.process.capture.maxval
         if self.invert:
-            a, b = self.process.capture.maxval, 0
+            a, b = maxval, 0
         else:
-            a, b = 0, self.process.capture.maxval
-        p.color_mapper.range.low_setting = a
-        p.color_mapper.range.high_setting = b
+            a, b = 0, maxval
+        m = color_map_name_dict[self.colormap](DataRange1D(
+            low_setting=a, high_setting=b))
+        rgb = m.map_screen(np.arange(maxval+1))[:, :3]
+        self.process.lut = (rgb*255).round().astype(np.uint8)
+        if self.grid is not None: # not if called from __init__
+            self.update_data()
+            self.screenplot.request_redraw()
 
     # TODO: bad layout for one frame at activation, track
     # value_range seems to be updated after index_range, take this
@@ -307,10 +394,11 @@ class Bullseye(HasTraits):
         px = self.process.capture.pixelsize
         self.process.capture.roi = [l, b, r-l, t-b]
 
-    def update_data(self):
+    def update_data(self, upd=None):
         if self.label is not None:
             self.label.text = self.process.text
-        upd = self.process.data
+        if upd is None:
+            upd = self.process.render()
         self.data.arrays.update(upd)
         self.data.data_changed = {"changed": upd.keys()}
         if self.grid is not None:
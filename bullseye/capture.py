@@ -17,11 +17,111 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from traits.api import (HasTraits, Float, Int, Str, Range, Bool,
-        ListFloat, Instance, Trait, Array, on_trait_change)
+        ListFloat, Instance, Trait, Array, Enum, Button, on_trait_change)
 
 import numpy as np
-from collections import deque
-import logging, time
+from threading import Lock
+import logging, time, urlparse, weakref, os, glob
+
+from .special_sums import percentile as _percentile
+from .writer import FrameWriter
+
+
+class BufferPool(object):
+    """Recycles frame buffers.
+
+    get() hands out a free buffer of the requested shape and dtype or a
+    new one, release() takes it back for reuse. Only buffers from get()
+    are taken back (also when released as views), buffers that are
+    never released are garbage collected as usual. At most `size` free
+    buffers are kept.
+    """
+    def __init__(self, size=4):
+        self.size = size
+        self.free = []
+        self.owned = weakref.WeakValueDictionary()
+        self.lock = Lock()
+
+    def get(self, shape, dtype):
+        dtype = np.dtype(dtype)
+        with self.lock:
+            for i, b in enumerate(self.free):
+                if b.shape == shape and b.dtype == dtype:
+                    return self.free.pop(i)
+        b = np.empty(shape, dtype)
+        self.owned[id(b)] = b
+        return b
+
+    def release(self, b):
+        while isinstance(b.base, np.ndarray):
+            b = b.base
+        with self.lock:
+            if (self.owned.get(id(b)) is b and len(self.free) < self.size
+                    and not any(f is b for f in self.free)):
+                self.free.append(b)
+
+
+class DarkLibrary(object):
+    """Dark images by camera settings.
+
+    Keys are (shutter, gain, mode) tuples, see BaseCapture.dark_key().
+    With a `path`, darks are also saved there as .npy files and loaded
+    memory mapped when they are not in memory.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.darks = {}
+        self.missing = set() # not on disk either
+        self.lock = Lock()
+
+    def name(self, key):
+        shutter, gain, (w, h, maxval) = key
+        return os.path.join(self.path, "dark_%g_%g_%ix%i_%i.npy" % (
+            shutter, gain, w, h, maxval))
+
+    def get(self, key):
+        with self.lock:
+            dark = self.darks.get(key)
+            if dark is None and self.path and key not in self.missing:
+                try:
+                    dark = np.load(self.name(key), mmap_mode="r")
+                    self.darks[key] = dark
+                except IOError:
+                    self.missing.add(key)
+            return dark
+
+    def put(self, key, dark):
+        with self.lock:
+            self.darks[key] = dark
+            self.missing.discard(key)
+            if self.path:
+                np.save(self.name(key), dark)
+                logging.debug("saved dark as %s", self.name(key))
+
+    def keys(self):
+        """Keys of the darks in memory and on disk."""
+        with self.lock:
+            keys = set(self.darks)
+        if self.path:
+            for n in glob.glob(os.path.join(self.path, "dark_*.npy")):
+                try:
+                    shutter, gain, wh, maxval = os.path.basename(
+                            n)[len("dark_"):-len(".npy")].split("_")
+                    w, h = wh.split("x")
+                    keys.add((float(shutter), float(gain),
+                        (int(w), int(h), int(maxval))))
+                except ValueError:
+                    pass
+        return keys
+
+    def nearest(self, key):
+        """The key of the dark with the same gain and mode and the
+        closest shutter, or None."""
+        shutter, gain, mode = key
+        keys = [k for k in self.keys() if k[1:] == (gain, mode)]
+        if not keys:
+            return None
+        return min(keys, key=lambda k: abs(k[0]-shutter))
 
 
 class BaseCapture(HasTraits):
@@ -40,17 +140,35 @@ class BaseCapture(HasTraits):
 
     roi = ListFloat(minlen=4, maxlen=4)
     
-    dark = Bool(False)
-    darkim = Trait(None, None, Array)
+    dark = Bool(False) # subtract the dark for the current settings
+    darks = Instance(DarkLibrary, ())
+    dark_frames = Range(1, 64, 8) # averaged per dark
+    take_dark = Button # (re)take the dark for the current settings
+    _dark_sum = None # [key, sum, frames] while taking a dark
+    # no dark for the current settings, the one with the closest
+    # shutter is subtracted (if any)
+    dark_missing = Bool(False)
+    _dark_fallback = None # (key, key of the subtracted dark)
     average = Range(1, 20, 1)
-    average_deque = Instance(deque, args=([], 20))
+    # boxcar over the last `average` frames or exponential moving
+    # average with a time constant of `average` frames
+    average_mode = Enum("boxcar", "ema")
 
-    im = Array
+    im = Array # boxcar sum or ema
+    average_ring = Trait(None, None, Array) # boxcar frames
+    _average_key = None
+    buffers = Instance(BufferPool, ())
     
     save_format = Str
+    save_codec = Enum("npz", "npz-stored", "npy")
+    save_block = Bool(False) # wait for the writer instead of dropping
+    save_queue = Int(16) # frames waiting to be written
+    writer = Instance(FrameWriter)
 
     def __init__(self, **k):
         super(BaseCapture, self).__init__(**k)
+        # id(frame): (frame, driver frame), see release()
+        self._held_frames = {}
         self.setup()
         px = self.pixelsize
         self.roi = [-self.width/px/2, -self.height/px/2,
@@ -65,13 +183,22 @@ class BaseCapture(HasTraits):
     def stop(self):
         pass
 
-    @on_trait_change("shutter, gain")
-    def _unset_dark(self):
-        self.dark = False
+    def dark_key(self):
+        return (float(self.shutter), float(self.gain),
+                (self.width, self.height, self.maxval))
 
     @on_trait_change("dark")
-    def _do_dark(self):
-        self.darkim = None # invalidate
+    def _do_dark(self, dark):
+        # the capture thread takes the next frames if there is no dark
+        if not dark:
+            self._dark_sum = None
+        elif self.darks.get(self.dark_key()) is None:
+            self._dark_sum = []
+
+    @on_trait_change("take_dark")
+    def _do_take_dark(self):
+        self.dark = True
+        self._dark_sum = []
 
     @on_trait_change("roi")
     def update_bounds(self, roi):
@@ -86,6 +213,48 @@ class BaseCapture(HasTraits):
     def dequeue(self):
         raise NotImplementedError
 
+    def save(self, im):
+        # a copy of the raw frame, written in the background
+        w = self.writer
+        if w is None:
+            w = self.writer = FrameWriter(self.save_codec, self.save_queue,
+                    self.save_block, self.buffers.release)
+        b = self.buffers.get(im.shape, im.dtype)
+        b[...] = im
+        if not w.put(time.strftime(self.save_format), b):
+            self.buffers.release(b)
+
+    @on_trait_change("save_format, save_codec, save_block, save_queue")
+    def close_writer(self):
+        """Write the queued frames, a new writer is started for the
+        next frame to save."""
+        w, self.writer = self.writer, None
+        if w is not None:
+            w.close()
+
+    def close(self):
+        self.close_writer()
+
+    def frame_dtype(self, n=1):
+        """Narrowest type for the sum of `n` frames, signed if the dark
+        image is subtracted."""
+        v = self.maxval*n
+        return np.min_scalar_type(-v if self.dark else v)
+
+    def can_hold(self):
+        """Whether the driver frame just dequeued may be handed out
+        without a copy and held until release()."""
+        return False
+
+    def release(self, im):
+        """Hand a frame returned by capture() back for reuse."""
+        held = self._held_frames.get(id(im))
+        if held is not None and held[0] is im: # not a recycled id
+            del self._held_frames[id(im)]
+            self.enqueue(held[1])
+        else:
+            self.buffers.release(im)
+
     def enqueue(self, im):
         pass
 
@@ -94,7 +263,7 @@ class BaseCapture(HasTraits):
 
     def auto(self, im, percentile=99.9, maxiter=10,
             minval=.25, maxval=.75, adjustment_factor=.5):
-        p = np.percentile(im, percentile)/float(self.maxval)
+        p = _percentile(im, percentile, self.maxval)/float(self.maxval)
         if not ((p < minval and self.shutter < self.max_shutter) or
                 (p > maxval and self.shutter > self.min_shutter)):
             return im # early return before setting framerate
@@ -103,7 +272,7 @@ class BaseCapture(HasTraits):
             self.enqueue(im)
             self.flush()
             im = self.dequeue()
-            p = np.percentile(im, percentile)/float(self.maxval)
+            p = _percentile(im, percentile, self.maxval)/float(self.maxval)
             s = "="
             if p > maxval and self.shutter > self.min_shutter:
                 self.shutter = max(self.min_shutter,
@@ -126,37 +295,139 @@ class BaseCapture(HasTraits):
 
     def capture(self):
         im = self.dequeue()
+        if im is None:
+            return None
         if self.auto_shutter:
             im = self.auto(im)
         if self.save_format:
-            name = time.strftime(self.save_format)
-            np.savez_compressed(name, im)
-            logging.debug("saved as %s", name)
-        im_ = np.array(im, dtype=np.int, copy=True)
+            self.save(im)
+        # the ui thread replaces it to restart or stop a dark
+        dark_sum = self._dark_sum
+        if self.dark and dark_sum is not None:
+            self._add_dark(im, dark_sum)
+            self.enqueue(im)
+            return None
+        dtype = self.frame_dtype()
+        # only the region of interest from here on
+        l, b, w, h = self.bounds
+        roi = im[b:b+h, l:l+w]
+        if (not self.dark and self.average == 1 and roi.dtype == dtype
+                and self.can_hold()):
+            # zero copy, the driver frame is enqueued in release()
+            if self._average_key is not None:
+                self._clear_average()
+            self._held_frames[id(roi)] = roi, im
+            return roi
+        im_ = self.buffers.get(roi.shape, dtype)
+        im_[...] = roi
         self.enqueue(im)
         im = im_
         if self.dark:
-            if self.darkim is None:
-                self.darkim = im
-                return None
-            else:
-                im -= self.darkim
+            # full frame, sliced to the bounds
+            dark = self._get_dark()
+            if dark is not None:
+                im -= dark[b:b+h, l:l+w]
         if self.average == 1:
-            self.average_deque.clear()
-            self.average_deque.append(im)
-            self.im = im
-        else:
-            if len(self.average_deque) == 1:
-                self.im = self.im.copy() # break ref
-            while len(self.average_deque) >= self.average:
-                self.im -= self.average_deque.popleft()
-            self.average_deque.append(im)
-            self.im += im
-            im = self.im/len(self.average_deque)
-        l, b, w, h = self.bounds
-        im = im[b:b+h, l:l+w]
+            if self._average_key is not None:
+                self._clear_average()
+        else: # float mean, keeps the precision gained by averaging
+            if self.average_mode == "ema":
+                mean = self._ema(im, (l, b))
+            else:
+                mean = self._boxcar(im, (l, b))
+            self.buffers.release(im)
+            im = mean
         return im
 
+    def _get_dark(self):
+        key = self.dark_key()
+        dark = self.darks.get(key)
+        if dark is not None:
+            if self.dark_missing:
+                self._dark_fallback = None
+                self.dark_missing = False
+            return dark
+        if self._dark_fallback is None or self._dark_fallback[0] != key:
+            # once per settings, this lists the library
+            near = self.darks.nearest(key)
+            self._dark_fallback = key, near
+            self.dark_missing = True
+            if near is None:
+                logging.warning("no dark for shutter %g, gain %g, "
+                        "not subtracted", key[0], key[1])
+            else:
+                logging.warning("no dark for shutter %g, gain %g, "
+                        "using the one for shutter %g", key[0], key[1],
+                        near[0])
+        near = self._dark_fallback[1]
+        if near is None:
+            return None
+        return self.darks.get(near)
+
+    def _add_dark(self, im, dark_sum):
+        key = self.dark_key()
+        if not dark_sum or dark_sum[0] != key:
+            # restart if the settings change
+            dark_sum = [key, np.zeros(im.shape,
+                np.min_scalar_type(self.maxval*self.dark_frames)), 0]
+            self._dark_sum = dark_sum
+        key, acc, n = dark_sum
+        acc += im
+        n += 1
+        if n < self.dark_frames:
+            dark_sum[2] = n
+        else: # rounded mean, compact
+            acc += n//2
+            acc //= n
+            self.darks.put(key, acc.astype(np.min_scalar_type(
+                self.maxval)))
+            if self._dark_sum is dark_sum: # not restarted meanwhile
+                self._dark_sum = None
+
+    def _clear_average(self):
+        self._average_key = None
+        self.average_ring = None
+        self.im = np.zeros((0, 0))
+
+    def _boxcar(self, im, origin):
+        # in place: running sum over a ring of frames, restarted if the
+        # bounds change
+        n = self.average
+        key = "boxcar", n, origin, im.shape, im.dtype
+        if self._average_key != key:
+            self._clear_average()
+            self._average_key = key
+            self.average_ring = np.empty((n,)+im.shape, im.dtype)
+            self.im = np.zeros(im.shape, self.frame_dtype(n))
+            self._count = self._next = 0
+        i = self._next
+        if self._count == n:
+            self.im -= self.average_ring[i]
+        else:
+            self._count += 1
+        self.average_ring[i] = im
+        self.im += im
+        self._next = (i+1) % n
+        mean = self.buffers.get(im.shape, np.float32)
+        np.true_divide(self.im, self._count, out=mean, casting="unsafe")
+        return mean
+
+    def _ema(self, im, origin):
+        # in place: one float accumulator and one scratch frame
+        key = "ema", origin, im.shape
+        if self._average_key != key:
+            self._clear_average()
+            self._average_key = key
+            self.im = im.astype(np.float32)
+            self._scratch = np.empty(im.shape, np.float32)
+        else:
+            np.subtract(im, self.im, out=self._scratch)
+            self._scratch *= 1./self.average
+            self.im += self._scratch
+        mean = self.buffers.get(im.shape, np.float32)
+        mean[...] = self.im
+        return mean
+
 
 class DummyCapture(BaseCapture):
     _data = None
@@ -178,3 +449,44 @@ class DummyCapture(BaseCapture):
         im = im*(1+np.random.randn(*im.shape)*.1)
         #im += np.random.randn(im.shape)*30
         return (im+.5).astype(np.uint8)
+
+
+def open_capture(uri):
+    """Open the camera given by `uri`, see the --camera option."""
+    scheme, loc, path, query, frag = urlparse.urlsplit(uri)
+    if scheme == "dc1394":
+        from .dc1394_capture import DC1394Capture
+        if loc == "guid":
+            cam = DC1394Capture(long(path[1:], base=16))
+    elif scheme == "fc2":
+        from .flycapture2_capture import Fc2Capture
+        if loc == "index":
+            cam = Fc2Capture(int(path[1:]))
+    elif scheme == "opencv":
+        from .opencv_capture import OpenCVCapture
+        if loc == "index":
+            cam = OpenCVCapture(int(path[1:]))
+    elif scheme == "replay":
+        from .replay_capture import ReplayCapture
+        if loc == "glob":
+            cam = ReplayCapture(path[1:])
+    elif scheme == "none":
+        cam = DummyCapture()
+    elif scheme == "any":
+        try:
+            from .dc1394_capture import DC1394Capture
+            cam = DC1394Capture()
+        except Exception, e:
+            logging.debug("dc1394 error: %s", e)
+            try:
+                from .flycapture2_capture import Fc2Capture
+                cam = Fc2Capture()
+            except Exception, e:
+                logging.debug("flycapture2 error: %s", e)
+                try:
+                    from .opencv_capture import OpenCVCapture
+                    cam = OpenCVCapture()
+                except Exception, e:
+                    logging.debug("opencv error: %s", e)
+                    cam = DummyCapture()
+    return cam
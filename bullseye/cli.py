@@ -0,0 +1,222 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+#
+#   bullseye - ccd laser beam profilers (pydc1394 + chaco)
+#   Copyright (C) 2012 Robert Jordens <robert@joerdens.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# headless: no traitsui/chaco/enable imports here or in the modules used
+
+import optparse, logging, functools, time, json, sys
+from collections import deque
+
+import numpy as np
+
+from .capture import open_capture, DarkLibrary
+from .process import Process
+
+
+def captured(cam, frames=0, held=None):
+    """Yield up to `frames` (0: unlimited) processed frames from `cam`,
+    appending their capture times and the frames to `held`."""
+    cam.start()
+    try:
+        n = 0
+        while not frames or n < frames:
+            im = cam.capture()
+            if im is None:
+                continue
+            if held is not None:
+                held.append((time.time(), im))
+            yield im
+            n += 1
+    finally:
+        cam.stop()
+
+
+def columns(dtype):
+    """Flat column names, sub-array fields are numbered."""
+    names = []
+    for n in dtype.names:
+        shape = dtype.fields[n][0].shape
+        if shape:
+            names.extend("%s_%i" % (n, i) for i in range(int(np.prod(shape))))
+        else:
+            names.append(n)
+    return names
+
+
+class CsvWriter(object):
+    def __init__(self, fil, dtype):
+        self.fil = fil
+        self.fil.write(",".join(columns(dtype))+"\n")
+
+    def write(self, r):
+        rows = np.hstack([r[n].reshape(len(r), -1).astype(np.double)
+            for n in r.dtype.names])
+        for row in rows:
+            self.fil.write(",".join("%.15g" % v for v in row)+"\n")
+
+
+class JsonWriter(object):
+    def __init__(self, fil, dtype):
+        self.fil = fil
+
+    def write(self, r):
+        for ri in r:
+            d = dict((n, ri[n].tolist()) for n in r.dtype.names)
+            self.fil.write(json.dumps(d, sort_keys=True)+"\n")
+
+
+class BinaryWriter(object):
+    def __init__(self, fil, dtype):
+        self.fil = fil
+        logging.info("binary records: %s", dtype.descr)
+
+    def write(self, r):
+        self.fil.write(r.tobytes())
+
+
+writers = {"csv": CsvWriter, "jsonl": JsonWriter, "binary": BinaryWriter}
+
+
+def main():
+    p = optparse.OptionParser(usage="%prog [options]",
+            description="Measure beams without the user interface and "
+                "stream one record per frame.")
+    p.add_option("-c", "--camera", default="any:",
+            help="camera uri (none:, any:, dc1394://guid/b09d01009981f9, "
+                 "fc2://index/1, replay://glob/beam*.npz) [%default]")
+    p.add_option("-o", "--output", default="-",
+            help="output file, - for stdout [%default]")
+    p.add_option("-f", "--format", default="csv", choices=sorted(writers),
+            help="output format: csv (with header), jsonl (one json "
+                "object per line) or binary (packed records, the dtype "
+                "is logged) [%default]")
+    p.add_option("-n", "--frames", type="int", default=0,
+            help="stop after this many frames, 0 for unlimited "
+                "[%default]")
+    p.add_option("-k", "--chunk", type="int", default=1,
+            help="frames per output write, larger is faster but "
+                "delays the records [%default]")
+    p.add_option("--save", default=None,
+            help="also save the frames according to this strftime() "
+                "format string (e.g. 'beam_%Y%m%d%H%M%S.npy') [%default]")
+    p.add_option("--codec", default="npz",
+            choices=["npz", "npz-stored", "npy"],
+            help="format of the saved frames: compressed npz, "
+                "uncompressed npz or npy [%default]")
+    p.add_option("--save-block", action="store_true", default=False,
+            help="wait for the frame writer instead of dropping frames "
+                "if it falls behind [%default]")
+    p.add_option("-a", "--server", action="store_true", default=False,
+            help="run the camera in a separate acquisition process "
+                "that hands frames over in shared memory [%default]")
+    p.add_option("-s", "--shutter", type="float", default=None,
+            help="shutter time [camera default]")
+    p.add_option("-g", "--gain", type="float", default=None,
+            help="gain [camera default]")
+    p.add_option("-A", "--auto-shutter", action="store_true",
+            default=False, help="adjust the shutter [%default]")
+    p.add_option("-D", "--darks", default=None,
+            help="keep the dark images in this directory, by shutter "
+                "and gain [%default]")
+    p.add_option("-K", "--dark", action="store_true", default=False,
+            help="subtract the dark image, the first frames are taken "
+                "as the dark if there is none for the shutter and gain "
+                "[%default]")
+    p.add_option("-r", "--crops", type="int", default=3,
+            help="crop iterations [%default]")
+    p.add_option("-i", "--ignore", type="float", default=.01,
+            help="energy outside the include region [%default]")
+    p.add_option("-b", "--background", type="float", default=0.,
+            help="background percentile [%default]")
+    p.add_option("-e", "--energy", default=".86,.95,.99",
+            help="encircled energy levels, empty for none [%default]")
+    p.add_option("-E", "--elliptical", action="store_true", default=False,
+            help="elliptical include region [%default]")
+    p.add_option("--adaptive", action="store_true", default=False,
+            help="stop cropping once the moments converge [%default]")
+    p.add_option("--pyramid", action="store_true", default=False,
+            help="first estimate from a block summed frame [%default]")
+    p.add_option("--sparse", action="store_true", default=False,
+            help="only use the pixels above the background [%default]")
+    p.add_option("-m", "--maxmem", type="int", default=None,
+            help="bound the temporary memory of the beam projections "
+                "to this many MB, useful for large sensors [%default]")
+    p.add_option("-l", "--log",
+            help="log output file [stderr]")
+    p.add_option("-d", "--debug", default="info",
+            help="log level (debug, info, warn, error, "
+                "critical, fatal) [%default]")
+    opts, args = p.parse_args()
+    logging.basicConfig(filename=opts.log,
+            level=getattr(logging, opts.debug.upper()),
+            format='%(asctime)s %(levelname)s %(message)s')
+    if opts.server:
+        from .shared_capture import SharedCapture
+        cam = SharedCapture(functools.partial(open_capture, opts.camera))
+    else:
+        cam = open_capture(opts.camera)
+    logging.debug("running with capture device: %s", cam)
+    if opts.shutter is not None:
+        cam.shutter = opts.shutter
+    if opts.gain is not None:
+        cam.gain = opts.gain
+    cam.auto_shutter = opts.auto_shutter
+    if opts.darks:
+        cam.darks = DarkLibrary(opts.darks)
+    cam.dark = opts.dark
+    if opts.save:
+        cam.trait_set(save_codec=opts.codec, save_block=opts.save_block,
+                save_format=opts.save)
+    proc = Process(capture=cam, crops=opts.crops, ignore=opts.ignore,
+            background=opts.background, elliptical=opts.elliptical,
+            adaptive=opts.adaptive, pyramid=opts.pyramid,
+            sparse=opts.sparse,
+            energy_levels=[float(e) for e in opts.energy.split(",") if e])
+    if opts.maxmem:
+        proc.maxmem = opts.maxmem<<20
+
+    rdtype = proc.result_dtype()
+    dtype = np.dtype([("time", np.double)]+[(n, rdtype.fields[n][0])
+        for n in rdtype.names])
+    if opts.output == "-":
+        fil = sys.stdout
+    else:
+        fil = open(opts.output, "wb" if opts.format == "binary" else "w")
+    writer = writers[opts.format](fil, dtype)
+    held = deque()
+    frames = captured(cam, opts.frames, held)
+    try:
+        for r in proc.iter_stack(frames, opts.chunk):
+            out = np.zeros(len(r), dtype)
+            for i in range(len(r)):
+                out["time"][i], im = held.popleft()
+                cam.release(im)
+            for n in rdtype.names:
+                out[n] = r[n]
+            writer.write(out)
+            fil.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        frames.close()
+        if fil is not sys.stdout:
+            fil.close()
+        cam.close()
+
+if __name__ == "__main__":
+    main()
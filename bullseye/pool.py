@@ -0,0 +1,117 @@
+#   bullseye - ccd laser beam profilers (pydc1394 + chaco)
+#   Copyright (C) 2012 Robert Jordens <robert@joerdens.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import deque
+from threading import Thread, Condition
+
+
+class OrderedPool(object):
+    """Worker threads applying `func` to submitted items, results are
+    handed out in submission order.
+
+    At most `maxpending` items wait for a worker. Submitting more
+    either drops the oldest waiting item (`drop_oldest`) or blocks
+    until a worker is free. Dropped items are skipped in the results
+    and handed to `drop(item)` if given. Numpy releases the GIL in most
+    kernels, so threads scale.
+    """
+    def __init__(self, func, workers=2, maxpending=None, drop_oldest=True,
+            drop=None):
+        self.func = func
+        self.drop = drop
+        self.maxpending = maxpending or workers
+        self.drop_oldest = drop_oldest
+        self.cond = Condition()
+        self.pending = deque() # (seq, item) waiting for a worker
+        self.done = {} # seq: (ok, result), None if dropped
+        self.submitted = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.closed = False
+        self.threads = [Thread(target=self._work) for i in range(workers)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def __len__(self):
+        """Items submitted but not yet handed out."""
+        return self.submitted-self.delivered
+
+    def submit(self, item):
+        with self.cond:
+            while len(self.pending) >= self.maxpending:
+                if self.drop_oldest:
+                    seq, old = self.pending.popleft()
+                    self.done[seq] = None
+                    self.dropped += 1
+                    if self.drop is not None:
+                        self.drop(old)
+                else:
+                    self.cond.wait()
+            self.pending.append((self.submitted, item))
+            self.submitted += 1
+            self.cond.notify_all()
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                seq, item = self.pending.popleft()
+                self.cond.notify_all()
+            try:
+                r = True, self.func(item)
+            except Exception as e:
+                r = False, e
+            with self.cond:
+                self.done[seq] = r
+                self.cond.notify_all()
+
+    def results(self, block=False):
+        """Yield the results that are ready, in order. With `block`,
+        wait for all submitted items. Exceptions raised by `func` are
+        re-raised here."""
+        while True:
+            with self.cond:
+                while block and len(self) and self.delivered not in self.done:
+                    self.cond.wait()
+                if self.delivered not in self.done:
+                    return
+                r = self.done.pop(self.delivered)
+                self.delivered += 1
+            if r is None: # dropped
+                continue
+            ok, r = r
+            if not ok:
+                raise r
+            yield r
+
+    def close(self):
+        """Drop the waiting items and stop the workers once the running
+        items are done."""
+        with self.cond:
+            while self.pending:
+                seq, item = self.pending.popleft()
+                self.done[seq] = None
+                self.dropped += 1
+                if self.drop is not None:
+                    self.drop(item)
+            self.closed = True
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
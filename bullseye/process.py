@@ -18,14 +18,16 @@
 
 
 from traits.api import (HasTraits, Float, Int, Unicode, Range, Bool,
-        Instance, on_trait_change, Dict, Event)
+        Instance, Trait, List, Any, Tuple, Array, on_trait_change)
 
 import numpy as np
-import logging, bisect
-from threading import Thread
+import logging, itertools, time
+from threading import Thread, Lock
 
-from .special_sums import angle_sum, polar_sum
+from .special_sums import (angle_sums, PlanCache, EncircledEnergy,
+        FrameStats, Histogram, SparseFrame, block_sum)
 from .capture import BaseCapture
+from .pool import OrderedPool
 
 
 class Process(HasTraits):
@@ -36,11 +38,30 @@ class Process(HasTraits):
 
     track = Bool(False)
     crops = Int(3) # crop iterations
+    adaptive = Bool(False) # stop iterating once the moments converge
+    tolerance = Float(.01) # convergence, relative to the beam radius
+    iterations = Int # crop iterations of the last frame
+    pyramid = Bool(False) # first estimate from a block summed frame
+    sparse = Bool(False) # only the pixels above the background
+    sparse_fraction = Float(.1) # dense if more pixels are above
+    _window = Any # adaptive start: shape, black, moments, crop size
     rad = Float(3/2.) # crop radius in beam diameters
 
     background = Range(0., 1., 0.)
     ignore = Range(0., .5, .01)
+    elliptical = Bool(False) # elliptical include region
     include_radius = Float
+    stats = Instance(FrameStats) # of the last crop
+    energy = Instance(EncircledEnergy) # of the current frame
+    energy_levels = List(Float) # reported encircled energy fractions
+    energy_radii = List(Float)
+
+    plans = Instance(PlanCache, ()) # special_sums bin index plans
+    workers = Int(0) # processing threads, 0: in the capture thread
+    pending = Int(2) # frames waiting for a worker
+    drop_oldest = Bool(True) # drop waiting frames instead of blocking
+    dropped = Int # frames dropped by the workers
+    maxmem = Trait(None, None, Int) # special_sums temporaries in bytes
 
     x = Float
     y = Float
@@ -54,24 +75,23 @@ class Process(HasTraits):
 
     text = Unicode
 
-    data = Dict()
-    new_data = Event()
+    _last = Any # analyze() result of the last frame, see render()
+    _subscribers = List # [callback, period, due]
+    viewport = Trait(None, None, Tuple(Int, Int)) # display size in pixels
+    lut = Trait(None, None, Array) # display colors by intensity
+
+    def __init__(self, **k):
+        super(Process, self).__init__(**k)
+        self._lock = Lock() # _last for the ui, see publish()
 
     def initialize(self):
         self.capture.start()
         im = self.capture.capture()
-        self.process(im.copy())
+        self.process(im)
         self.capture.stop()
 
     def moments(self, im):
-        y, x = np.ogrid[:im.shape[0], :im.shape[1]]
-        imx, imy = im.sum(axis=0)[None, :], im.sum(axis=1)[:, None]
-        m00 = float(imx.sum()) or 1.
-        m10, m01 = (imx*x).sum()/m00, (imy*y).sum()/m00
-        x, y = x-m10, y-m01
-        m20, m02 = (imx*x**2).sum()/m00, (imy*y**2).sum()/m00
-        m11 = (im*x*y).sum()/m00
-        return m00, m10, m01, m20, m02, m11
+        return FrameStats(im).moments
 
     def poly(self, imx, m1, m2):
         w = m2**.5/2 # +- .5sigma
@@ -89,85 +109,439 @@ class Process(HasTraits):
         t = .5*np.arctan2(2*m11, m20-m02)
         return p, a, b, t
 
-    def do_crop(self, imc, m00, m10, m01, m20, m02, m11):
+    def encircled_energy(self, imc, m00, m10, m01, m20, m02, m11):
+        ellipse = None
+        if self.elliptical:
+            wp, wa, wb, wt = self.gauss(m00, m20, m02, m11)
+            if wb > 0: # not degenerate
+                # coarse quantization for cache hits
+                q = np.deg2rad(2.)
+                ellipse = max(1, round(wb/wa*32))/32., round(wt/q)*q
+        return EncircledEnergy(imc, center=(m01, m10), aspect=1.,
+                binsize=1., ellipse=ellipse, cache=self.plans,
+                maxmem=self.maxmem)
+
+    def crop_widths(self, m20, m02, energy=None):
+        """Include radius and half widths of the crop around the beam."""
+        if energy is None:
+            energy = self.energy
         if self.ignore > 0: # crop based on encircled energy
-            # TODO: ellipse
-            re = polar_sum(imc, center=(m01, m10),
-                direction="azimuthal", aspect=1., binsize=1.)
-            np.cumsum(re, out=re)
-            rinc = bisect.bisect(re, (1.-self.ignore)*m00)
-            w20 = w02 = rinc
+            rinc = float(energy.radius(1.-self.ignore))
+            ellipse = energy.ellipse
+            if ellipse is None:
+                w20 = w02 = rinc
+            else: # bounding box of the ellipse
+                ra, rb = rinc, rinc*ellipse[0]
+                ct, st = np.cos(ellipse[1]), np.sin(ellipse[1])
+                w20 = ((ra*ct)**2+(rb*st)**2)**.5
+                w02 = ((ra*st)**2+(rb*ct)**2)**.5
         else: # crop based on 3 sigma region
             w20 = self.rad*4*m20**.5
             w02 = self.rad*4*m02**.5
             rinc = ((w20**2+w02**2)/2)**.5
+        return rinc, w20, w02
+
+    def crop_bounds(self, shape, m10, m01, w20, w02):
         w02 = max(w02, 4)
         w20 = max(w20, 4)
         lc = int(max(0, m10-w20))
         bc = int(max(0, m01-w02))
-        tc = int(min(imc.shape[0], m01+w02))
-        rc = int(min(imc.shape[1], m10+w20))
+        tc = int(min(shape[0], m01+w02))
+        rc = int(min(shape[1], m10+w20))
+        return lc, bc, rc, tc
+
+    def do_crop(self, imc, m00, m10, m01, m20, m02, m11, energy=None):
+        rinc, w20, w02 = self.crop_widths(m20, m02, energy)
+        lc, bc, rc, tc = self.crop_bounds(imc.shape, m10, m01, w20, w02)
         imc = imc[bc:tc, lc:rc]
         return rinc, lc, bc, rc, tc, imc
 
-    def process(self, im):
-        im = np.array(im)
-        lc, bc = 0, 0
+    def converged(self, a, b):
+        x0, y0, m200, m020, m110 = a
+        x1, y1, m201, m021, m111 = b
+        r2 = m201+m021
+        if not r2 > 0: # empty crop: the beam left the window
+            return False
+        return ((x1-x0)**2+(y1-y0)**2 <= self.tolerance**2*r2 and
+                abs(m201-m200)+abs(m021-m020)+2*abs(m111-m110)
+                <= self.tolerance*r2)
+
+    def pyramid_factor(self, shape):
+        # keep at least 128 pixels along the short side
+        f = 1
+        while f < 8 and min(shape) >= 256*f:
+            f *= 2
+        return f
+
+    def coarse_start(self, im, hist, f):
         black = 0
         if self.background > 0:
-            imc = im.copy()
+            if hist is None:
+                black = np.percentile(im, self.background*100)
+            else:
+                black = hist.percentile(self.background*100)
+        imc = block_sum(im, f)
+        if black:
+            imc = np.maximum(imc-f*f*black, 0)
+        m00, m10, m01, m20, m02, m11 = FrameStats(imc).moments
+        # block centers and the variance within a block
+        m10, m01 = f*m10+(f-1)/2., f*m01+(f-1)/2.
+        v = (f*f-1)/12.
+        m20, m02, m11 = f*f*m20+v, f*f*m02+v, f*f*m11
+        w20 = max(self.rad*4*m20**.5, 2*f)
+        w02 = max(self.rad*4*m02**.5, 2*f)
+        rinc = ((w20**2+w02**2)/2)**.5
+        lc = int(max(0, m10-w20))
+        bc = int(max(0, m01-w02))
+        tc = int(min(im.shape[0], m01+w02))
+        rc = int(min(im.shape[1], m10+w20))
+        return bc, tc, lc, rc, black, None, rinc
+
+    def measure_window(self, im, window):
+        # moments in the crop of the last frame, None if they differ
+        # from those of the last frame or, as the beam drifts, from
+        # those of the last full frame
+        shape, black, ref, size, rinc, w20, w02 = window
+        lc, bc, rc, tc = self.crop_bounds(shape, ref[0], ref[1], w20, w02)
+        imc = im[bc:tc, lc:rc]
+        if black:
+            imc = np.clip(imc-black, 0, self.capture.maxval)
+        blackp = black
+        if self.background > 0:
+            blackc = np.percentile(imc, self.background*100)
+            imc = imc-blackc
+            np.clip(imc, 0, self.capture.maxval, out=imc)
+            black += blackc
+        stats = FrameStats(imc)
+        m00, m10, m01, m20, m02, m11 = stats.moments
+        m = m10+lc, m01+bc, m20, m02, m11
+        if not (self.converged(ref, m) and
+                self.converged(m[:2]+size, m)):
+            return None
+        # follow the beam, the energy in the crop would be truncated
+        if self.ignore > 0:
+            f = ((m20+m02)/(ref[2]+ref[3]))**.5
+            rinc, w20, w02 = f*rinc, f*w20, f*w02
         else:
-	    imc = im
-        for i in range(self.crops):
+            rinc, w20, w02 = self.crop_widths(m20, m02)
+        return dict(m00=m00, m10=m[0], m01=m[1], m20=m20, m02=m02,
+                m11=m11, black=black, rinc=rinc, iterations=1,
+                stats=stats, full=None, energy=None, sparse=None,
+                window=(shape, blackp, m, size, rinc, w20, w02))
+
+    def measure(self, im, window=None):
+        """Moments of the beam in a frame, no traits are changed.
+
+        `window` is the adaptive start returned by the previous call.
+        Returns a dict with the moments (m10, m01 in frame pixels),
+        black, rinc, iterations, the FrameStats of the last crop
+        (stats) and of the full frame (full, or None), the
+        EncircledEnergy (energy, or None, also on an adaptive warm
+        start), the SparseFrame (sparse, or None) and the adaptive
+        start for the next frame (window)."""
+        if (self.adaptive and window is not None and
+                window[0] == im.shape):
+            # the last crop if the beam did not change, else the frame
+            r = self.measure_window(im, window)
+            if r is not None:
+                return r
+        rinc = 0
+        full = None
+        energy = None
+        hist0 = None
+        if self.background > 0:
+            im0 = im.copy()
+            if Histogram.applicable(im, self.capture.maxval):
+                hist0 = Histogram(im, self.capture.maxval)
+        else:
+            im0 = im
+        sparse = None
+        if self.sparse:
+            # one threshold from the full frame
+            sblack = 0
             if self.background > 0:
-                blackc = np.percentile(imc, self.background*100)
-                imc = imc-blackc
-                np.clip(imc, 0, self.capture.maxval, out=imc)
+                if hist0 is None:
+                    sblack = np.percentile(im, self.background*100)
+                else:
+                    sblack = hist0.percentile(self.background*100)
+            # work on the pixels above it only, if few
+            if (np.count_nonzero(im > sblack) <=
+                    self.sparse_fraction*im.size):
+                sparse = SparseFrame(im, sblack)
+        crops = self.crops
+        start = None
+        if self.pyramid and crops > 1:
+            f = self.pyramid_factor(im.shape)
+            if f > 1:
+                # replaces the first, full frame, iteration
+                start = self.coarse_start(im0, hist0, f)
+                crops -= 1
+        imc, hist = im0, hist0
+        if sparse is not None:
+            imc, hist = sparse, None
+        lc, bc = 0, 0
+        black = 0
+        last = None
+        if start is not None:
+            bc, tc, lc, rc, black, last, rinc = start
+            imc = imc[bc:tc, lc:rc]
+            if hist is not None:
+                hist = hist.crop(bc, tc, lc, rc)
+            if black and not isinstance(imc, SparseFrame):
+                imc = np.clip(imc-black, 0, self.capture.maxval)
+        if imc is sparse:
+            black = sblack
+        for i in range(crops):
+            blackp = black
+            # the full SparseFrame is clipped at the frame percentile
+            if self.background > 0 and imc is not sparse:
+                if isinstance(imc, SparseFrame): # same as dense
+                    blackc = imc.percentile(self.background*100)
+                    imc = imc.clip(blackc)
+                else:
+                    if hist is None:
+                        blackc = np.percentile(imc, self.background*100)
+                    else: # exact, imc is the clipped and shifted raw crop
+                        blackc = hist.percentile(self.background*100, black)
+                    imc = imc-blackc
+                    np.clip(imc, 0, self.capture.maxval, out=imc)
                 black += blackc
-            m00, m10, m01, m20, m02, m11 = self.moments(imc)
-            if i < self.crops-1:
-                rinc, dlc, dbc, drc, dtc, imc = self.do_crop(
+            stats = FrameStats(imc)
+            if i == 0 and (imc is im or imc is sparse):
+                full = stats # projections of the full frame
+            m00, m10, m01, m20, m02, m11 = stats.moments
+            if i == 0 and (self.ignore > 0 or self.energy_levels):
+                # once per frame, reused for all crops and levels
+                energy = self.encircled_energy(
                         imc, m00, m10, m01, m20, m02, m11)
+            m = m10+lc, m01+bc, m20, m02, m11
+            if self.adaptive:
+                if last is not None and self.converged(last, m):
+                    break
+                last = m
+            if i < crops-1:
+                rinc, dlc, dbc, drc, dtc, imc = self.do_crop(
+                        imc, m00, m10, m01, m20, m02, m11, energy)
                 lc += dlc
                 bc += dbc
-
-        m10 += lc
-        m01 += bc
+                if hist is not None:
+                    hist = hist.crop(dbc, dtc, dlc, drc)
+        window = None
+        if self.adaptive:
+            # crop for the next frames, also sets the include radius
+            rinc, w20, w02 = self.crop_widths(m20, m02, energy)
+            window = (im.shape, blackp, m, m[2:], rinc, w20, w02)
+        return dict(m00=m00, m10=m[0], m01=m[1], m20=m20, m02=m02,
+                m11=m11, black=black, rinc=rinc, iterations=i+1,
+                stats=stats, full=full, energy=energy, sparse=sparse,
+                window=window)
+
+    def beam(self, m00, m10, m01, m20, m02, m11, black, rinc,
+            bounds=None):
+        """Beam parameters in physical units from the moments in
+        frame pixels, also for arrays of moments. `bounds` of the
+        frames default to the current ones."""
         wp, wa, wb, wt = self.gauss(m00, m20, m02, m11)
-
         px = self.capture.pixelsize
-        l, b, w, h = self.capture.bounds
-        
-        self.m00 = m00
-        self.m20 = m20
-        self.m02 = m02
-        self.black = black/self.capture.maxval
-        self.peak = (wp+black)/self.capture.maxval
-        self.x = (m10+l-self.capture.width/2)*px
-        self.y = (m01+b-self.capture.height/2)*px
-        self.t = np.rad2deg(wt)
-        self.a = wa*px
-        self.b = wb*px
-        self.d = ((self.a**2+self.b**2)/2)**.5
-        self.e = wb/wa
-        self.include_radius = rinc*px
+        if bounds is None:
+            bounds = self.capture.bounds
+        l, b = bounds[:2]
+        return dict(
+                x=(m10+l-self.capture.width/2)*px,
+                y=(m01+b-self.capture.height/2)*px,
+                t=np.rad2deg(wt), a=wa*px, b=wb*px,
+                d=((wa**2+wb**2)/2)**.5*px, e=wb/wa,
+                black=black/self.capture.maxval,
+                peak=(wp+black)/self.capture.maxval,
+                include_radius=rinc*px)
+
+    def result_dtype(self):
+        fields = [(n, np.double) for n in ("x", "y", "a", "b", "t", "e",
+            "d", "black", "peak", "include_radius",
+            "m00", "m10", "m01", "m20", "m02", "m11")]
+        fields.append(("iterations", np.int32))
+        if self.energy_levels:
+            fields.append(("energy_radii", np.double,
+                (len(self.energy_levels),)))
+        return np.dtype(fields)
+
+    def process_stack(self, frames, chunk=64):
+        """Beam parameters of a stack or an iterable of frames.
+
+        No traits are changed. Each frame is measured as in
+        `process()`, the adaptive start is carried from frame to frame.
+        The beam parameters are derived for `chunk` frames at once. With
+        a single crop, no background subtraction and no encircled
+        energy, the moments of a chunk are also taken at once.
+
+        Returns a structured array with one record per frame, see
+        `result_dtype()`."""
+        out = list(self.iter_stack(frames, chunk))
+        if not out:
+            return np.zeros(0, self.result_dtype())
+        return np.concatenate(out)
+
+    def iter_stack(self, frames, chunk=64):
+        """Like `process_stack()` but yields the records chunk by
+        chunk, as soon as they are available."""
+        dtype = self.result_dtype()
+        levels = list(self.energy_levels)
+        px = self.capture.pixelsize
+        stacked = (self.crops == 1 and self.background == 0 and
+                not self.sparse and not self.adaptive and
+                self.ignore == 0 and not levels)
+        if isinstance(frames, np.ndarray):
+            chunks = (frames[i:i+chunk]
+                    for i in range(0, frames.shape[0], chunk))
+        else:
+            frames = iter(frames)
+            chunks = iter(lambda: list(itertools.islice(frames, chunk)),
+                    [])
+        window = None
+        for c in chunks:
+            r = np.zeros(len(c), dtype)
+            black, rinc = np.zeros(len(c)), np.zeros(len(c))
+            if stacked:
+                s = FrameStats(np.asarray(c))
+                for n in "m00", "m10", "m01", "m20", "m02", "m11":
+                    r[n] = getattr(s, n)
+                r["iterations"] = 1
+            else:
+                for i, im in enumerate(c):
+                    ri = self.measure(np.asarray(im), window)
+                    window = ri["window"]
+                    for n in ("m00", "m10", "m01", "m20", "m02", "m11",
+                            "iterations"):
+                        r[n][i] = ri[n]
+                    black[i], rinc[i] = ri["black"], ri["rinc"]
+                    if levels and ri["energy"] is None: # warm start
+                        r["energy_radii"][i] = np.nan
+                    elif levels:
+                        r["energy_radii"][i] = px*ri["energy"].radius(
+                                levels)
+            for n, v in self.beam(r["m00"], r["m10"], r["m01"], r["m20"],
+                    r["m02"], r["m11"], black, rinc).items():
+                r[n] = v
+            yield r
+
+    def analyze(self, im, window=None, t=None, bounds=None):
+        """measure() followed by the beam parameters (beam). The frame
+        is kept (im) for the plot data, see render(), with its capture
+        time `t` (time) and region (bounds, default: the current one).
+        No traits are changed."""
+        if bounds is None:
+            bounds = tuple(self.capture.bounds)
+        r = self.measure(im, window)
+        r["time"] = time.time() if t is None else t
+        r["beam"] = self.beam(r["m00"], r["m10"], r["m01"], r["m20"],
+                r["m02"], r["m11"], r["black"], r["rinc"], bounds)
+        r["im"] = im
+        r["bounds"] = bounds
+        r["data"] = None
+        return r
+
+    def subscribe(self, callback, rate=None):
+        """Call `callback(r)` with the analyze() result of processed
+        frames, at most `rate` times per second (None: every frame).
+        The plot data is rendered into r["data"] before. Plot data is
+        only computed while there are subscribers. Returns a handle for
+        unsubscribe()."""
+        s = [callback, 1./rate if rate else 0., 0.]
+        self._subscribers.append(s)
+        return s
+
+    def unsubscribe(self, s):
+        self._subscribers.remove(s)
+
+    def render(self, r=None):
+        """Plot data and markers of `r` (default: the last frame),
+        computed once and cached in r["data"]."""
+        if r is None:
+            # the frame is released once it is no longer the last
+            with self._lock:
+                r = self._last
+                if r is None:
+                    return None
+                return self.render(r)
+        if r["data"] is None:
+            upd = self.plot_data(r["im"], r)
+            upd.update(self.markers())
+            r["data"] = upd
+        return r["data"]
+
+    def publish(self, r):
+        """Set the traits from the result of analyze() and hand it to
+        the subscribers that are due."""
+        px = self.capture.pixelsize
+        self._window = r["window"]
+        self.stats, self.energy = r["stats"], r["energy"]
+        self.iterations = r["iterations"]
+        self.m00 = r["m00"]
+        self.m20 = r["m20"]
+        self.m02 = r["m02"]
+        self.trait_set(**r["beam"])
+        if self.energy is not None:
+            self.energy_radii = list(px*self.energy.radius(
+                self.energy_levels))
+        elif self.energy_levels: # not measured on a warm start
+            self.energy_radii = [np.nan]*len(self.energy_levels)
 
         self.update_text()
 
+        with self._lock: # no ui reader is left on the previous frame
+            last, self._last = self._last, r
+        if last is not None:
+            self.capture.release(last["im"])
+        t = time.time()
+        for s in list(self._subscribers):
+            if t >= s[2]:
+                s[2] = t+s[1]
+                self.render(r)
+                s[0](r)
+
+    def process(self, im, t=None, bounds=None):
+        # keeps memmap frames, release() knows them by identity
+        im = np.asanyarray(im)
+        self.publish(self.analyze(im, self._window, t, bounds))
+
+    def plot_data(self, im, r):
+        full, sparse = r["full"], r["sparse"]
+        m00, m10, m01 = r["m00"], r["m10"], r["m01"]
+        m20, m02, m11 = r["m20"], r["m02"], r["m11"]
+        wp, wa, wb, wt = self.gauss(m00, m20, m02, m11)
+
+        px = self.capture.pixelsize
+        l, b, w, h = r["bounds"]
+
         x = np.arange(l, l+w)-self.capture.width/2
         y = np.arange(b, b+h)-self.capture.height/2
-        xbounds = (np.r_[x, x[-1]+1]-.5)*px
-        ybounds = (np.r_[y, y[-1]+1]-.5)*px
-        imx = im.sum(axis=0) # TODO: available from moments()
-        imy = im.sum(axis=1)
-        gx = (m00/(2*np.pi*m20)**.5)*np.exp(-(x-self.x/px)**2/(m20*2))
-        gy = (m00/(2*np.pi*m02)**.5)*np.exp(-(y-self.y/px)**2/(m02*2))
+        f = self.display_factor(im.shape)
+        img = im if f == 1 else block_sum(im, f)//(f*f)
+        if self.lut is not None: # precolored, out of range values clip
+            img = self.lut.take(img.astype(np.intp, copy=False), axis=0,
+                    mode="clip")
+        if img is im: # the frame is reused after publish()
+            img = im.copy()
+        w, h = img.shape[1]*f, img.shape[0]*f
+        xbounds = (np.r_[x[:w:f], x[w-1]+1]-.5)*px
+        ybounds = (np.r_[y[:h:f], y[h-1]+1]-.5)*px
+        if full is None and sparse is not None:
+            full = FrameStats(sparse)
+        if full is None: # moments were taken after background subtraction
+            imx, imy = im.sum(axis=0), im.sum(axis=1)
+        else:
+            imx, imy = full.imx, full.imy
+        bx, by = r["beam"]["x"]/px, r["beam"]["y"]/px
+        gx = (m00/(2*np.pi*m20)**.5)*np.exp(-(x-bx)**2/(m20*2))
+        gy = (m00/(2*np.pi*m02)**.5)*np.exp(-(y-by)**2/(m02*2))
 
         #TODO: center pixel bin rounding effect still there?
         xc, yc = m10-im.shape[1]/2., m01-im.shape[0]/2.
         dab = max(abs(np.cos(wt)), abs(np.sin(wt))) # minimize binning artefacts
-        ima = angle_sum(im, wt, binsize=dab)
-        imb = angle_sum(im, wt+np.pi/2, binsize=dab)
+        # natural binsize (~dab) for both: no bin index needed
+        ima, imb = angle_sums(im if sparse is None else sparse,
+                (wt, wt+np.pi/2), cache=self.plans,
+                maxmem=self.maxmem)
         xcr = (np.cos(wt)*xc+np.sin(wt)*yc)/dab+ima.shape[0]/2.
         ycr = (-np.sin(wt)*xc+np.cos(wt)*yc)/dab+imb.shape[0]/2.
         ima0 = int(max(0, xcr-self.rad*wa/dab))
@@ -184,8 +558,8 @@ class Process(HasTraits):
         #print self.poly(imb, ycr-imb0, (wb/4)**2), (wb/4)**2
 
         # im = (im[:, :, None]*[[[1,1,1]]]).astype(np.uint8) # speed test
-        upd = dict((
-            ("img", im),
+        return dict((
+            ("img", img),
             ("xbounds", xbounds), ("ybounds", ybounds),
             ("x", x*px), ("y", y*px),
             ("imx", imx), ("imy", imy),
@@ -194,9 +568,36 @@ class Process(HasTraits):
             ("ima", ima), ("imb", imb),
             ("ga", ga), ("gb", gb),
             ))
-        upd.update(self.markers())
-        self.data = upd
-        self.new_data = True
+
+    def display_factor(self, shape):
+        """Block size for the display image of a frame of `shape`, the
+        largest that still covers the viewport."""
+        if self.viewport is None:
+            return 1
+        vw, vh = self.viewport
+        return max(1, min(shape[1]//max(1, vw), shape[0]//max(1, vh)))
+
+    @on_trait_change("lut")
+    def _invalidate_render(self):
+        r = self._last
+        if r is not None:
+            r["data"] = None
+
+    def pixel(self, x, y):
+        """Full resolution (column, row, value) of the last frame at the
+        position x, y (as in the plot data) or None if outside."""
+        px = self.capture.pixelsize
+        with self._lock: # see publish()
+            r = self._last
+            if r is None:
+                return None
+            l, b, w, h = r["bounds"]
+            i = int(np.floor(x/px+self.capture.width/2+.5))
+            j = int(np.floor(y/px+self.capture.height/2+.5))
+            im = r["im"]
+            if not (l <= i < l+im.shape[1] and b <= j < b+im.shape[0]):
+                return None
+            return i, j, im[j-b, i-l]
 
     def markers(self):
         px = self.capture.pixelsize
@@ -252,6 +653,19 @@ class Process(HasTraits):
             u"black-peak: %.4g-%.4g\n"
             u"include radius: %.4g µm\n"
             ) % fields
+        if self.adaptive:
+            self.text += u"iterations: %i\n" % self.iterations
+        if self.energy_radii:
+            self.text += u"encircled %s%%: %s µm\n" % (
+                    "/".join("%.4g" % (100*p) for p in self.energy_levels),
+                    "/".join("%.4g" % r for r in self.energy_radii))
+
+    @on_trait_change("ignore")
+    def _update_include_radius(self):
+        # crops change with the next frame, the radius is available now
+        if self.energy is not None and self.ignore > 0:
+            self.include_radius = float(self.energy.radius(
+                1.-self.ignore))*self.capture.pixelsize
 
     def do_track(self):
         r = self.rad
@@ -291,16 +705,34 @@ class Process(HasTraits):
     def run(self):
         logging.debug("start")
         self.capture.start()
+        pool = None
+        if self.workers > 0:
+            # results are published in frame order by this thread
+            pool = OrderedPool(lambda a: self.analyze(a[0], self._window,
+                a[1], a[2]), self.workers, self.pending, self.drop_oldest,
+                lambda a: self.capture.release(a[0]))
         while self.active:
             im = self.capture.capture()
             if im is None:
                 continue
+            # the frames in flight keep their region if it changes
+            t, bounds = time.time(), tuple(self.capture.bounds)
             try:
-                self.process(im.copy())
-                if self.track:
-                    self.do_track()
+                if pool is None:
+                    self.process(im, t, bounds)
+                    if self.track:
+                        self.do_track()
+                else:
+                    pool.submit((im, t, bounds))
+                    for r in pool.results():
+                        self.publish(r)
+                        if self.track:
+                            self.do_track()
+                    self.dropped = pool.dropped
             except ValueError:
                 pass # keep going
+        if pool is not None:
+            pool.close()
         logging.debug("stop")
         self.capture.stop()
         self.thread = None
@@ -37,4 +37,7 @@ class ReplayCapture(BaseCapture):
         self.height, self.width = self.dequeue().shape
 
     def dequeue(self):
-        return np.load(self.names.next())["arr_0"]
+        im = np.load(self.names.next(), mmap_mode="r")
+        if not isinstance(im, np.ndarray): # npz
+            im = im["arr_0"]
+        return im
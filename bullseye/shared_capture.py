@@ -0,0 +1,228 @@
+# -*- coding: utf8 -*-
+#
+#   bullseye - ccd laser beam profilers (pydc1394 + chaco)
+#   Copyright (C) 2012 Robert Jordens <robert@joerdens.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from traits.api import Range, Int, Any, on_trait_change
+
+import numpy as np
+import multiprocessing, tempfile, time, os
+
+from .capture import BaseCapture
+
+
+class FrameRing(object):
+    """Fixed ring of frame slots in shared memory.
+
+    The writer fills the oldest slot that is not held by the reader and
+    tags it with a sequence number. The reader takes the newest frame
+    and holds its slot until it is released, held slots are never
+    overwritten. The frames live in a file backed map (in /dev/shm if
+    available) that is attached to by both processes.
+    """
+    def __init__(self, slots=4):
+        self.slots = slots
+        self.cond = multiprocessing.Condition()
+        self.seqs = multiprocessing.RawArray("l", slots) # 0: invalid
+        self.held = multiprocessing.RawArray("i", slots)
+        self.frames = None
+
+    def create(self, shape, dtype):
+        d = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        f = tempfile.NamedTemporaryFile(prefix="bullseye-", dir=d)
+        self.frames = np.memmap(f, dtype, "w+", shape=(self.slots,)+shape)
+        self._file = f # removed when closed
+        return f.name
+
+    def attach(self, name, shape, dtype):
+        self.frames = np.memmap(name, dtype, "r+",
+                shape=(self.slots,)+shape)
+
+    def acquire(self):
+        """Writer: slot to fill next, blocks while all slots are held."""
+        with self.cond:
+            while True:
+                free = [i for i in range(self.slots) if not self.held[i]]
+                if free:
+                    break
+                self.cond.wait()
+            i = min(free, key=lambda i: self.seqs[i])
+            self.seqs[i] = 0
+            return i
+
+    def publish(self, i, seq):
+        with self.cond:
+            self.seqs[i] = seq
+            self.cond.notify_all()
+
+    def take(self, last, timeout=None):
+        """Reader: hold the newest slot with a sequence number above
+        `last`. Returns (slot, seq) or None on timeout."""
+        end = None if timeout is None else time.time()+timeout
+        with self.cond:
+            while True:
+                i = max(range(self.slots), key=lambda i: self.seqs[i])
+                if self.seqs[i] > last:
+                    self.held[i] += 1
+                    return i, self.seqs[i]
+                if end is None:
+                    self.cond.wait()
+                else:
+                    t = end-time.time()
+                    if t <= 0:
+                        return None
+                    self.cond.wait(t)
+
+    def release(self, i):
+        with self.cond:
+            self.held[i] -= 1
+            self.cond.notify_all()
+
+
+def _serve(factory, conn, ring):
+    # acquisition process: owns the camera, one copy per frame from
+    # the driver buffer into the ring
+    cam = factory()
+    shape = cam.height, cam.width
+    dtype = np.uint8 if cam.maxval < 1<<8 else np.uint16
+    ranges = {}
+    for name in "shutter", "gain", "framerate":
+        h = cam.trait(name).handler
+        ranges[name] = (getattr(h, "_low", None), getattr(h, "_high", None),
+                getattr(cam, name))
+    conn.send(dict(shape=shape, dtype=np.dtype(dtype).str,
+        ranges=ranges, traits=dict(pixelsize=cam.pixelsize,
+            maxval=cam.maxval, min_shutter=cam.min_shutter,
+            max_shutter=cam.max_shutter,
+            max_framerate=cam.max_framerate)))
+    ring.attach(conn.recv(), shape, dtype)
+    running = False
+    seq = 0
+    while True:
+        if not running or conn.poll():
+            cmd = conn.recv()
+            if cmd[0] == "start":
+                cam.start()
+                running = True
+            elif cmd[0] == "stop":
+                cam.stop()
+                running = False
+            elif cmd[0] == "set":
+                setattr(cam, cmd[1], cmd[2])
+            elif cmd[0] == "flush":
+                cam.flush()
+                conn.send(seq)
+            elif cmd[0] == "close":
+                break
+            continue
+        im = cam.dequeue()
+        if im is None:
+            continue
+        i = ring.acquire()
+        ring.frames[i] = im
+        cam.enqueue(im)
+        seq += 1
+        ring.publish(i, seq)
+    if running:
+        cam.stop()
+    conn.close()
+
+
+class SharedCapture(BaseCapture):
+    """Runs the capture returned by `factory()` in a separate process.
+
+    Frames are handed over in a `FrameRing` and returned by dequeue()
+    as views of their slot until they are enqueue()d again. Shutter,
+    gain and framerate changes are forwarded to the camera. The
+    factory needs to be picklable where processes are not forked.
+    """
+    factory = Any
+    slots = Int(4)
+    missed = Int # frames overwritten before they were taken
+
+    def __init__(self, factory, **k):
+        self.factory = factory
+        super(SharedCapture, self).__init__(**k)
+
+    def setup(self):
+        self.ring = FrameRing(self.slots)
+        self.conn, conn = multiprocessing.Pipe()
+        self.server = multiprocessing.Process(target=_serve,
+                args=(self.factory, conn, self.ring))
+        self.server.daemon = True
+        self.server.start()
+        conn.close() # only the child's end: eof if the child dies
+        try:
+            info = self.conn.recv()
+        except EOFError:
+            self.server.join()
+            raise IOError("acquisition process failed (exit code %s)" %
+                    self.server.exitcode)
+        shape, dtype = tuple(info["shape"]), np.dtype(info["dtype"])
+        self.conn.send(self.ring.create(shape, dtype))
+        self.height, self.width = shape
+        self.trait_set(**info["traits"])
+        self._forward = False
+        for name, (low, high, value) in info["ranges"].items():
+            if low is not None and high is not None:
+                self.add_trait(name, Range(low, high, value))
+            setattr(self, name, value)
+        self._forward = True
+        self._last = 0
+        self._held = {}
+
+    @on_trait_change("shutter, gain, framerate")
+    def _do_forward(self, name, value):
+        if getattr(self, "_forward", False):
+            self.conn.send(("set", name, value))
+
+    def start(self):
+        self.conn.send(("start",))
+
+    def stop(self):
+        self.conn.send(("stop",))
+
+    def flush(self):
+        self.conn.send(("flush",))
+        self._last = max(self._last, self.conn.recv())
+
+    def dequeue(self):
+        r = self.ring.take(self._last, timeout=1.)
+        if r is None:
+            return None
+        i, seq = r
+        if seq > self._last+1 and self._last:
+            self.missed += seq-self._last-1
+        self._last = seq
+        im = self.ring.frames[i]
+        self._held[id(im)] = im, i # keeps the id unique while held
+        return im
+
+    def can_hold(self):
+        # leave the writer a free slot
+        return len(self._held) <= self.slots-2
+
+    def enqueue(self, im):
+        held = self._held.get(id(im))
+        if held is not None and held[0] is im:
+            del self._held[id(im)]
+            self.ring.release(held[1])
+
+    def close(self):
+        super(SharedCapture, self).close()
+        if self.server.is_alive():
+            self.conn.send(("close",))
+            self.server.join(5)
@@ -18,14 +18,133 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import numpy as np
+from collections import OrderedDict
+from threading import Lock
 
-def angle_sum(m, angle, aspect=1., binsize=None):
+
+class PlanCache(object):
+    """Bounded least-recently-used cache of bin index plans.
+
+    Building the bin index is the expensive part of `angle_sum` and
+    `polar_sum`. For a stream of frames with the same shape and nearly
+    the same angle, the index can be reused and each call reduces to a
+    single `np.bincount`.
+
+    Parameters
+    ----------
+    maxbytes : int, optional
+        Upper bound on the memory held by the cached plans. The least
+        recently used plans are evicted to stay below it.
+    quantum : float, optional
+        Angles are rounded to multiples of `quantum` (in radians) before
+        they are used as keys. Zero disables quantization.
+    center_quantum : float, optional
+        Fractional parts of `polar_sum` centers are rounded to multiples
+        of `center_quantum`. Integer center shifts reuse the same plan.
+
+    Attributes
+    ----------
+    nbytes : int
+        Memory currently held by the cached plans.
+    hits, misses : int
+        Lookup statistics, see also `hit_rate`.
+
+    Examples
+    --------
+    >>> c = PlanCache(maxbytes=100)
+    >>> c.get("a", lambda: (np.arange(10), 10))[1]
+    10
+    >>> c.get("a", lambda: None)[1]
+    10
+    >>> c.get("b", lambda: (np.arange(10), 10))[1]
+    10
+    >>> len(c), c.hits, c.misses, c.hit_rate
+    (1, 1, 2, 0.3333333333333333)
+    >>> c.quantize(.1) == round(.1/c.quantum)*c.quantum
+    True
+    """
+    def __init__(self, maxbytes=64<<20, quantum=2*np.pi/3600,
+            center_quantum=.5):
+        self.maxbytes = maxbytes
+        self.quantum = quantum
+        self.center_quantum = center_quantum
+        self.plans = OrderedDict()
+        self.lock = Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.plans)
+
+    def __repr__(self):
+        return "<PlanCache %i plans, %i bytes, %i hits, %i misses>" % (
+                len(self), self.nbytes, self.hits, self.misses)
+
+    @property
+    def hit_rate(self):
+        return self.hits/float(self.hits+self.misses or 1)
+
+    def quantize(self, angle):
+        if not self.quantum:
+            return angle
+        return round(angle/self.quantum)*self.quantum
+
+    def split_center(self, center):
+        """Split `center` into integer and quantized fractional parts."""
+        q = self.center_quantum
+        ci = np.floor(center)
+        cf = np.round((center-ci)/q)*q
+        ci, cf = ci+np.floor(cf), cf-np.floor(cf)
+        return tuple(int(c) for c in ci), tuple(float(c) for c in cf)
+
+    def get(self, key, make):
+        """Return the plan for `key`, calling `make()` to build it if it
+        is not cached. Thread safe, `make()` runs without the lock."""
+        with self.lock:
+            plan = self.plans.pop(key, None)
+            if plan is not None:
+                self.hits += 1
+                self.plans[key] = plan
+                return plan
+            self.misses += 1
+        plan = make()
+        with self.lock:
+            old = self.plans.pop(key, None)
+            if old is not None: # built concurrently
+                self.nbytes -= self._nbytes(old)
+            self.plans[key] = plan
+            self.nbytes += self._nbytes(plan)
+            while self.nbytes > self.maxbytes and self.plans:
+                self.nbytes -= self._nbytes(
+                        self.plans.popitem(last=False)[1])
+        return plan
+
+    def discard(self, key):
+        with self.lock:
+            plan = self.plans.pop(key, None)
+            if plan is not None:
+                self.nbytes -= self._nbytes(plan)
+
+    def clear(self):
+        with self.lock:
+            self.plans.clear()
+            self.nbytes = 0
+
+    @staticmethod
+    def _nbytes(plan):
+        return sum(getattr(a, "nbytes", 0) for a in plan)
+
+
+def angle_sum(m, angle, aspect=1., binsize=None, cache=None,
+        maxmem=None):
     """Compute the sum of a 2D array along an rotated axis.
 
     Parameters
     ----------
-    m : array_like, shape(N, M)
-        2D input array to be summed
+    m : array_like, shape(N, M) or shape(L, N, M)
+        2D input array to be summed or stack of 2D arrays to be summed
+        individually, or a `SparseFrame`
     angle : float
         The angle of the summation direction defined such that:
             angle_sum(m, angle=0) == np.sum(m, axis=0)
@@ -38,15 +157,24 @@ def angle_sum(m, angle, aspect=1., binsize=None):
         size" which is the larger projection of the two input step sizes
         onto the output dimension (the axis perpendicular to the
         summation axis).
+    cache : PlanCache, optional
+        Cache to look up and store the bin index plan in. `angle` is
+        quantized according to the cache.
+    maxmem : int, optional
+        Upper bound in bytes on the temporary memory. If the full array
+        needs more, it is processed in blocks of rows, bypassing
+        `cache`. The result is identical.
 
     Returns
     -------
-    out : ndarray, shape(K)
+    out : ndarray, shape(K) or shape(L, K)
         The sum of `m` along the axis at `angle`.
 
     See also
     --------
     polar_sum : similar method summing azimuthally or radially
+    angle_sums : several angles at once
+    PlanCache : reuse of bin index plans between calls
 
     Notes
     -----
@@ -79,6 +207,9 @@ def angle_sum(m, angle, aspect=1., binsize=None):
     The function uses floor(coordinate+.5) to bin (c.f. around, rint,
     trunc).
 
+    Integer input (up to 32 bits) is summed exactly and returned as
+    int64.
+
     Examples
     --------
     >>> m = np.arange(9.).reshape((3, 3))
@@ -125,36 +256,257 @@ def angle_sum(m, angle, aspect=1., binsize=None):
     (10099,)
     >>> angle_sum(m2, np.pi/4).sum() == m2.sum()
     True
+    >>> c = PlanCache()
+    >>> np.all(angle_sum(m2, np.pi/4, cache=c) == angle_sum(m2, np.pi/4))
+    True
+    >>> np.all(angle_sum(m2, np.pi/4, cache=c) == angle_sum(m2, np.pi/4))
+    True
+    >>> c.hits, c.misses
+    (1, 1)
+    >>> m3 = np.arange(3*4*5).reshape((3, 4, 5))
+    >>> angle_sum(m3, 1).shape
+    (3, 7)
+    >>> all(np.all(angle_sum(m3, 1)[i] == angle_sum(m3[i], 1))
+    ...     for i in range(3))
+    True
+    >>> m4 = np.random.randn(101, 103)
+    >>> np.all(angle_sum(m4, 1, maxmem=10000) == angle_sum(m4, 1))
+    True
+    >>> angle_sum(np.ones((2, 3), np.uint8), 0)
+    array([2, 2, 2])
     """
+    if isinstance(m, SparseFrame):
+        return m._angle_sum(angle, aspect, binsize)
     m = np.atleast_2d(m)
+    shape = m.shape[-2:]
+    rows = _tile_rows(shape, maxmem)
+    if rows:
+        n = _angle_coefficients(shape, angle, aspect, binsize)[-1]
+        return _tiled_bincount(lambda r: _angle_index(shape, angle,
+            aspect, binsize, r)[0], n, m[..., ::-1, :], rows)
+    if cache is None:
+        k, n = _angle_index(shape, angle, aspect, binsize)
+    else:
+        angle = cache.quantize(angle)
+        k, n = cache.get(("angle", shape, angle, aspect, binsize),
+                lambda: _angle_index(shape, angle, aspect, binsize))
+    # first axis needs to be inverted for the angle convention
+    # to make sense
+    return _bincount(k, n, m[..., ::-1, :])
+
+
+def _accumulator(m):
+    # integer sums are exact, returned as such
+    if m.dtype.kind in "biu" and m.dtype.itemsize <= 4:
+        return np.int64
+    return np.double
+
+
+# elements of the batched bin index in _bincount()
+_BATCH = 1<<16
+
+def _bincount(k, n, m):
+    # np.bincount(k, m.ravel(), n) for m or each 2D array in the stack m
+    if m.ndim == 2:
+        return np.bincount(k, m.ravel(), n).astype(_accumulator(m))
+    out = np.empty((m.shape[0], n), _accumulator(m))
+    # one shared bin index with n bins offset per frame
+    step = max(1, min(m.shape[0], _BATCH//max(1, k.size)))
+    kk = (k+n*np.arange(step)[:, None]).ravel()
+    for i in range(0, m.shape[0], step):
+        l = min(step, m.shape[0]-i)
+        out[i:i+l] = np.bincount(kk[:l*k.size], m[i:i+l].ravel(),
+                l*n).reshape((l, n))
+    return out
+
+
+# bytes of temporaries per element in _bincount() and the indices
+_ELEMENT_BYTES = 24
+
+def _tile_rows(shape, maxmem):
+    # rows per block to stay below maxmem, None if no tiling is needed
+    if maxmem is None or _ELEMENT_BYTES*shape[0]*shape[1] <= maxmem:
+        return None
+    return max(1, maxmem//(2*_ELEMENT_BYTES*shape[1]))
+
+
+def _tiled_bincount(index, n, m, rows):
+    # _bincount(index(slice(None)), n, m) in blocks of rows given by
+    # index(slice), n grows if needed
+    out = np.zeros(m.shape[:-2]+(n,))
+    for r in range(0, m.shape[-2], rows):
+        r = slice(r, min(r+rows, m.shape[-2]))
+        k = index(r)
+        if k.size and k.max() >= n:
+            n = int(k.max())+1
+            out = np.concatenate((out,
+                np.zeros(out.shape[:-1]+(n-out.shape[-1],))), axis=-1)
+        # carry the previous sums in front of the block to reproduce
+        # the summation order of a single np.bincount()
+        k = np.concatenate((np.arange(n), k))
+        mr = m[..., r, :]
+        if m.ndim == 2:
+            out = np.bincount(k, np.concatenate((out, mr.ravel())), n)
+        else:
+            for i in range(m.shape[0]):
+                out[i] = np.bincount(k, np.concatenate((out[i],
+                    mr[i].ravel())), n)
+    return out.astype(_accumulator(m))
+
+
+def _angle_coefficients(shape, angle, aspect, binsize):
     if binsize is None:
         binsize = max(abs(np.cos(angle)*aspect),
                       abs(np.sin(angle)))
-    # first axis needs to be inverted for the angle convention
-    # to make sense
-    m = m[::-1]
+    a, b = np.cos(angle)*aspect/binsize, np.sin(angle)/binsize
+    # output array size
+    i, j = np.array([0, 0, shape[0]-1, shape[0]-1]), \
+           np.array([0, shape[1]-1, 0, shape[1]-1])
+    k = a*j-b*i
+    km = k.min()
+    n = int(np.floor(k.max()-(km-.5)))+1
+    return a, b, km, n
+
+
+def _angle_index(shape, angle, aspect, binsize, rows=slice(None)):
+    a, b, km, n = _angle_coefficients(shape, angle, aspect, binsize)
     # original coordinates
-    i, j = np.ogrid[:m.shape[0], :m.shape[1]]
+    i, j = np.ogrid[:shape[0], :shape[1]]
+    i = i[rows]
     # output coordinate
-    k = (np.cos(angle)*aspect/binsize)*j-(np.sin(angle)/binsize)*i
-    # output array size
-    cx, cy = (0, 0, -1, -1), (0, -1, 0, -1)
-    km = k[cx, cy].min()
-    #kp = k[cx, cy].max()
-    #assert k.min() == km
-    #assert k.max() == kp
+    k = a*j-b*i
     # output bin index
-    k = np.floor(k-(km-.5)).astype(np.int)
-    return np.bincount(k.ravel(), m.ravel()) #, minlength=kp-km
+    k = np.floor(k-(km-.5)).astype(np.intp)
+    return k.ravel(), n
 
 
-def polar_sum(m, center, direction, aspect=1., binsize=None):
-    """Compute the sum of a 2D array radially or azimuthally.
+def angle_sums(m, angles, aspect=1., binsize=None, cache=None,
+        maxmem=None):
+    """Compute the sums of a 2D array along several rotated axes.
 
     Parameters
     ----------
     m : array_like, shape(N, M)
-        2D input array to be summed
+        2D input array to be summed, or a `SparseFrame`
+    angles : sequence of float
+        The angles of the summation directions, see `angle_sum`.
+    aspect : float, optional
+        The input bin aspect ratio (second dimension/first dimension).
+    binsize : float, optional
+        The output bin size, see `angle_sum`. If None, the natural bin
+        size for each angle is used.
+    cache : PlanCache, optional
+        Cache for bin index plans. Only used for angles where the bin
+        size differs from the natural bin size.
+    maxmem : int, optional
+        Upper bound in bytes on the temporary memory for angles where
+        the bin size differs from the natural bin size, see `angle_sum`.
+
+    Returns
+    -------
+    out : list of ndarray, shape(K)
+        The sums of `m` along the axes at `angles`.
+
+    See also
+    --------
+    angle_sum : the single angle version
+
+    Notes
+    -----
+    The result is the same as that of
+    [angle_sum(m, angle, ...) for angle in angles]
+    up to the binning of elements that are within rounding error of a
+    bin edge. The full array sum is strictly conserved for each output.
+
+    With the natural bin size, the elements of each row (or each column
+    for angles closer to pi/2) fall into consecutive bins and the row
+    is added to the output as a whole. No bin index is built and each
+    angle costs about one pass over `m` (or its transposed copy shared
+    between all angles). Integer input is accumulated natively without
+    conversion to float. Other bin sizes fall back to np.bincount on
+    shared weights.
+
+    Examples
+    --------
+    >>> m = np.arange(9.).reshape((3, 3))
+    >>> t = np.linspace(-np.pi, np.pi, 17)
+    >>> all(np.all(s == angle_sum(m, a)) for s, a in
+    ...     zip(angle_sums(m, t), t))
+    True
+    >>> all(np.all(s == angle_sum(m, a, binsize=.6)) for s, a in
+    ...     zip(angle_sums(m, t, binsize=.6), t))
+    True
+    >>> all(np.all(s == angle_sum(m, a, aspect=2)) for s, a in
+    ...     zip(angle_sums(m, t, aspect=2), t))
+    True
+    >>> m2 = np.arange(1e6).reshape((100, 10000))
+    >>> s0, s1, s2 = angle_sums(m2, (0, np.pi/2, np.pi/4))
+    >>> np.all(s0 == m2.sum(axis=0)), np.all(s1 == m2.sum(axis=1))
+    (True, True)
+    >>> s2.shape, s2.sum() == m2.sum()
+    ((10099,), True)
+    """
+    if isinstance(m, SparseFrame):
+        return [m._angle_sum(angle, aspect, binsize) for angle in angles]
+    m = np.atleast_2d(m)
+    # first axis needs to be inverted for the angle convention
+    # to make sense
+    mf = m[::-1]
+    i, j = np.arange(m.shape[0]), np.arange(m.shape[1])
+    acc = _accumulator(m)
+    # integers are accumulated natively, floats as double
+    dtype = m.dtype if acc is np.int64 else np.double
+    rows, cols, w = None, None, None
+    out = []
+    for angle in angles:
+        a, b, km, n = _angle_coefficients(m.shape, angle, aspect,
+                binsize)
+        if abs(a) == 1: # rows into consecutive bins
+            if rows is None:
+                rows = np.asarray(mf, dtype=dtype)
+            r = _shear_sum(rows, a, -b*i-(km-.5), n, acc)
+        elif abs(b) == 1: # columns into consecutive bins
+            if cols is None:
+                cols = np.ascontiguousarray(mf.T, dtype=dtype)
+            r = _shear_sum(cols, -b, a*j-(km-.5), n, acc)
+        elif _tile_rows(m.shape, maxmem):
+            r = angle_sum(m, angle, aspect, binsize, maxmem=maxmem)
+        else:
+            if w is None:
+                w = mf.ravel().astype(np.double)
+            if cache is None:
+                k, n = _angle_index(m.shape, angle, aspect, binsize)
+            else:
+                angle = cache.quantize(angle)
+                k, n = cache.get(("angle", m.shape, angle, aspect,
+                    binsize), lambda: _angle_index(m.shape, angle,
+                        aspect, binsize))
+            r = np.bincount(k, w, n).astype(acc)
+        out.append(r)
+    return out
+
+
+def _shear_sum(m, sign, offset, n, dtype):
+    # row l of m goes to bins floor(offset[l])+sign*index
+    offset = np.floor(offset).astype(np.intp)
+    if sign < 0:
+        m = m[:, ::-1]
+        offset -= m.shape[1]-1
+    out = np.zeros(n, dtype)
+    for r, o in zip(m, offset.tolist()):
+        out[o:o+m.shape[1]] += r
+    return out
+
+
+def polar_sum(m, center, direction, aspect=1., binsize=None,
+        ellipse=None, cache=None, maxmem=None):
+    """Compute the sum of a 2D array radially or azimuthally.
+
+    Parameters
+    ----------
+    m : array_like, shape(N, M) or shape(L, N, M)
+        2D input array to be summed or stack of 2D arrays to be summed
+        individually, or a `SparseFrame`
     center : tuple(float, float)
         The center of the summation measured from the [0, 0] index
         in units of the two input step sizes.
@@ -165,15 +517,28 @@ def polar_sum(m, center, direction, aspect=1., binsize=None):
     binsize : int, optional
         The output bin size. If None is given, and direction="radial"
         then binsize=2*pi/100, else binsize=min(1, aspect).
+    ellipse : tuple(float, float), optional
+        Sum azimuthally over ellipses instead of circles. Given as
+        (minor/major axis ratio, major axis angle), the radius is
+        measured along the major axis. Only for direction="azimuthal".
+    cache : PlanCache, optional
+        Cache to look up and store bin index maps in. The fractional
+        part of `center` and the ellipse are quantized according to the
+        cache. Maps are reused across integer shifts of `center`.
+    maxmem : int, optional
+        Upper bound in bytes on the temporary memory. If the full array
+        needs more, it is processed in blocks of rows, bypassing
+        `cache`. The result is identical.
 
     Returns
     -------
-    out : ndarray, shape(K)
+    out : ndarray, shape(K) or shape(L, K)
         The radial or azimuthal sum of `m`.
 
     See also
     --------
     angle_sum : similar method summing along angled parallel lines
+    PlanCache : reuse of bin index plans between calls
 
     Notes
     -----
@@ -206,6 +571,9 @@ def polar_sum(m, center, direction, aspect=1., binsize=None):
 
     The function uses (coordinate).astype(np.int) to bin.
 
+    Integer input (up to 32 bits) is summed exactly and returned as
+    int64.
+
     Examples
     --------
     >>> m = np.arange(1., 10.).reshape((3, 3))
@@ -233,33 +601,553 @@ def polar_sum(m, center, direction, aspect=1., binsize=None):
     >>> m2 = np.arange(123*345).reshape((123, 345))
     >>> polar_sum(m2, (67, 89), "radial", binsize=2*np.pi/1011).shape[0]
     1011
+    >>> m3 = np.array([[0, 1, 0], [2, 0, 4], [0, 8, 0]])
+    >>> polar_sum(m3, (1, 1), "azimuthal", binsize=1., ellipse=(.5, 0))
+    array([ 0.,  6.,  9.])
+    >>> polar_sum(m3, (1, 1), "azimuthal", binsize=1., ellipse=(.5, np.pi/2))
+    array([ 0.,  9.,  6.])
+    >>> c = PlanCache()
+    >>> for center in (67, 89), (67.5, 89.5), (60, 80), (60.5, 80.5):
+    ...     for direction in "radial", "azimuthal":
+    ...         assert np.all(polar_sum(m2, center, direction, cache=c) ==
+    ...                       polar_sum(m2, center, direction))
+    >>> c.hits, c.misses
+    (4, 4)
+    >>> m3 = np.arange(3*4*5).reshape((3, 4, 5))
+    >>> polar_sum(m3, (1, 2), "azimuthal").shape
+    (3, 3)
+    >>> all(np.all(polar_sum(m3, (1, 2), "radial")[i] ==
+    ...            polar_sum(m3[i], (1, 2), "radial")) for i in range(3))
+    True
+    >>> m4 = np.random.randn(101, 103)
+    >>> np.all(polar_sum(m4, (20, 30), "azimuthal", maxmem=10000) ==
+    ...        polar_sum(m4, (20, 30), "azimuthal"))
+    True
     """
-    m = np.atleast_2d(m)
-    # original coordinates
-    i, j = np.ogrid[:m.shape[0], :m.shape[1]]
-    i, j = i-center[0], j-center[1]
-    # output coordinate
     if direction == "azimuthal":
-        k = (j**2*aspect**2+i**2)**.5
         if binsize is None:
             binsize = min(1., aspect)
         minlength = None
     elif direction == "radial":
-        k = np.arctan2(i, j*aspect)+np.pi
+        if ellipse is not None:
+            raise ValueError("ellipse needs direction='azimuthal'")
         if binsize is None:
             binsize = 2*np.pi/100
         minlength = int(2*np.pi/binsize)+1
     else:
         raise ValueError("direction needs to be 'radial' or 'azimuthal'")
-    k = (k/binsize).astype(np.int)
-    r = np.bincount(k.ravel(), m.ravel(), minlength)
+    if isinstance(m, SparseFrame):
+        r = m._polar_sum(center, direction, aspect, binsize, ellipse,
+                minlength)
+        rows = cache = None
+    else:
+        m = np.atleast_2d(m)
+        shape = m.shape[-2:]
+        rows = _tile_rows(shape, maxmem)
+    if rows:
+        r = _tiled_bincount(lambda r: _polar_index(
+            np.ogrid[r, :shape[1]], center, direction, aspect,
+            binsize, ellipse).ravel(), minlength or 0, m, rows)
+    elif not isinstance(m, SparseFrame):
+        if cache is None:
+            k = _polar_index(np.ogrid[:shape[0], :shape[1]], center,
+                    direction, aspect, binsize, ellipse)
+        else:
+            k = _cached_polar_index(cache, shape, center,
+                    direction, aspect, binsize, ellipse)
+        k = k.ravel()
+        r = _bincount(k, minlength or int(k.max())+1, m)
     if direction == "radial":
-        assert r.shape[0] == minlength, (r.shape, minlength)
-        r[0] += r[-1]
-        r = r[:-1]
+        r[..., 0] += r[..., -1]
+        r = r[..., :-1]
     return r
 
 
+def _polar_index(ij, center, direction, aspect, binsize, ellipse):
+    # original coordinates
+    i, j = ij
+    i, j = i-center[0], j-center[1]
+    # output coordinate
+    if direction == "azimuthal":
+        if ellipse is None:
+            k = (j**2*aspect**2+i**2)**.5
+        else:
+            e, t = ellipse
+            j = j*aspect
+            i, j = (np.cos(t)*i-np.sin(t)*j)/e, np.sin(t)*i+np.cos(t)*j
+            k = (j**2+i**2)**.5
+    else:
+        k = np.arctan2(i, j*aspect)+np.pi
+    return (k/binsize).astype(np.intp)
+
+
+def _cached_polar_index(cache, shape, center, direction, aspect,
+        binsize, ellipse):
+    (ci, cj), cf = cache.split_center(center)
+    if ellipse is not None:
+        ellipse = tuple(cache.quantize(e) for e in ellipse)
+    key = ("polar", direction, cf, aspect, binsize, ellipse)
+    # the map is for a canvas of twice the half-size (h, w) with
+    # the center at [h, w]+cf
+    def make(h=0, w=0):
+        h = max(h, shape[0], ci, shape[0]-ci)
+        w = max(w, shape[1], cj, shape[1]-cj)
+        k = _polar_index(np.ogrid[-h:h, -w:w], cf, direction, aspect,
+                binsize, ellipse)
+        if k.max() < 1<<15: # compact storage
+            k = k.astype(np.int16)
+        else:
+            k = k.astype(np.int32)
+        return k, h, w
+    k, h, w = cache.get(key, make)
+    if not (shape[0]-h <= ci <= h and shape[1]-w <= cj <= w):
+        cache.discard(key)
+        k, h, w = cache.get(key, lambda: make(h, w))
+    return k[h-ci:h-ci+shape[0], w-cj:w-cj+shape[1]].astype(np.intp)
+
+
+class EncircledEnergy(object):
+    """Energy encircled by a radius around a center.
+
+    The azimuthal sum is computed once and then queried for any energy
+    fraction or radius with a binary search.
+
+    Parameters
+    ----------
+    m : array_like, shape(N, M)
+        2D input array, or a `SparseFrame`
+    center, aspect, binsize, ellipse, cache, maxmem :
+        See `polar_sum`.
+
+    Attributes
+    ----------
+    cumulative : ndarray, shape(K)
+        Energy within the radii binsize, 2*binsize, ... K*binsize.
+    total : float
+        Total energy.
+
+    See also
+    --------
+    polar_sum : the azimuthal sum
+
+    Examples
+    --------
+    >>> m = np.arange(1., 10.).reshape((3, 3))
+    >>> e = EncircledEnergy(m, (1, 1))
+    >>> e.cumulative
+    array([  5.,  45.])
+    >>> e.radius(.1), e.radius(.5), e.radius(1)
+    (0.0, 1.0, 2.0)
+    >>> e.radius([.1, .5])
+    array([ 0.,  1.])
+    >>> e.fraction(1.5) == 5/45.
+    True
+    """
+    def __init__(self, m, center, aspect=1., binsize=1., ellipse=None,
+            cache=None, maxmem=None):
+        self.center = center
+        self.binsize = binsize
+        self.ellipse = ellipse
+        self.cumulative = np.cumsum(polar_sum(m, center, "azimuthal",
+            aspect, binsize, ellipse, cache, maxmem))
+        self.total = self.cumulative[-1]
+
+    def radius(self, p):
+        """Largest bin edge radius that encircles no more than the
+        fraction `p` of the total energy."""
+        return np.searchsorted(self.cumulative, np.multiply(p,
+            self.total), side="right")*float(self.binsize)
+
+    def fraction(self, r):
+        """Fraction of the total energy encircled by the bin edge
+        radius below `r`."""
+        i = np.floor(np.divide(r, self.binsize)).astype(np.intp)-1
+        e = self.cumulative[np.clip(i, 0, len(self.cumulative)-1)]
+        return np.where(i >= 0, e, 0)/float(self.total or 1)
+
+
+class FrameStats(object):
+    """Projections and moments of an image.
+
+    The row and column sums and the first row moments are taken in one
+    sweep each. All moments up to second order follow from these
+    without full size temporaries.
+
+    Parameters
+    ----------
+    m : array_like, shape(N, M) or shape(L, N, M)
+        2D input array, a stack of 2D arrays, or a `SparseFrame`
+
+    Attributes
+    ----------
+    imx, imy : ndarray, shape(M), shape(N) or shape(L, M), shape(L, N)
+        Column and row sums.
+    m00 : float or ndarray, shape(L)
+        Total, 1 if zero.
+    m10, m01 : float or ndarray, shape(L)
+        Centroid along the columns and along the rows.
+    m20, m02, m11 : float or ndarray, shape(L)
+        Central second moments.
+
+    Examples
+    --------
+    >>> m = np.array([[0, 1, 0], [1, 4, 2], [0, 1, 0]])
+    >>> s = FrameStats(m)
+    >>> s.imx, s.imy
+    (array([1, 6, 2]), array([1, 7, 1]))
+    >>> s.m00, s.m10, s.m01
+    (9.0, 1.1111111111111112, 1.0)
+    >>> np.allclose(s.moments, (9, 10/9., 1, 26/81., 2/9., 0))
+    True
+    >>> t = FrameStats([m, m.T, 0*m])
+    >>> t.m00, t.m10
+    (array([ 9.,  9.,  1.]), array([ 1.11111111,  1.        ,  0.        ]))
+    >>> np.allclose(t.m11, 0), t.m20[0] == s.m20, t.m02[1] == s.m20
+    (True, True, True)
+    """
+    def __init__(self, m):
+        if isinstance(m, SparseFrame):
+            x, y = np.arange(m.shape[1]), np.arange(m.shape[0])
+            imx, imy, mx = m._projections()
+        else:
+            m = np.asarray(m)
+            n, k = m.shape[-2:]
+            x = np.arange(k, dtype=np.int64 if m.dtype.kind in "iub"
+                    else np.result_type(m.dtype, np.float32))
+            y = np.arange(n)
+            imx, imy = m.sum(axis=-2), m.sum(axis=-1)
+            mx = m.dot(x) # first x moment of each row
+        self.imx, self.imy = imx, imy
+        m00 = np.array(imx.sum(axis=-1), np.double)
+        m00[m00 == 0] = 1.
+        m10, m01 = imx.dot(x)/m00, imy.dot(y)/m00
+        x, y = x-m10[..., None], y-m01[..., None]
+        m20 = (imx*x**2).sum(axis=-1)/m00
+        m02 = (imy*y**2).sum(axis=-1)/m00
+        m11 = (y*(mx-m10[..., None]*imy)).sum(axis=-1)/m00
+        if m00.ndim == 0:
+            m00, m10, m01, m20, m02, m11 = (float(v) for v in
+                    (m00, m10, m01, m20, m02, m11))
+        self.m00, self.m10, self.m01 = m00, m10, m01
+        self.m20, self.m02, self.m11 = m20, m02, m11
+
+    @property
+    def moments(self):
+        """(m00, m10, m01, m20, m02, m11)"""
+        return (self.m00, self.m10, self.m01, self.m20, self.m02,
+                self.m11)
+
+
+class SparseFrame(object):
+    """Above-threshold pixels of an image as index and value lists.
+
+    For images where the signal covers a small part of the frame.
+    `FrameStats`, `angle_sum`, `angle_sums`, `polar_sum` and
+    `EncircledEnergy` accept a `SparseFrame` instead of an array and
+    then cost O(K) in the number of kept pixels. They give the same
+    results as for the dense array np.clip(m-threshold, 0, None).
+
+    Parameters
+    ----------
+    m : array_like, shape(N, M)
+        2D input array
+    threshold : float, optional
+        Pixels above `threshold` are kept, with `threshold` subtracted.
+
+    Attributes
+    ----------
+    shape : tuple(int, int)
+        Shape of the frame.
+    i, j : ndarray, shape(K)
+        Row and column indices of the kept pixels.
+    v : ndarray, shape(K)
+        Their values.
+
+    Notes
+    -----
+    Slicing with two contiguous slices crops the frame and shifts
+    the indices: `s[b:t, l:r]` corresponds to `m[b:t, l:r]`.
+    `percentile()` and `clip()` act on the dense array, for
+    background subtraction on a `SparseFrame`.
+
+    Examples
+    --------
+    >>> m = np.array([[0, 1, 0], [1, 5, 2], [0, 1, 0]])
+    >>> s = SparseFrame(m, 1)
+    >>> s.i, s.j, s.v
+    (array([1, 1]), array([1, 2]), array([4, 1]))
+    >>> d = np.clip(m-1, 0, None)
+    >>> all(np.all(angle_sum(s, t) == angle_sum(d, t))
+    ...     for t in np.linspace(-np.pi, np.pi, 17))
+    True
+    >>> np.all(polar_sum(s, (.5, 1), "azimuthal") ==
+    ...        polar_sum(d, (.5, 1), "azimuthal"))
+    True
+    >>> np.all(polar_sum(s, (.5, 1), "radial") ==
+    ...        polar_sum(d, (.5, 1), "radial"))
+    True
+    >>> FrameStats(s).moments == FrameStats(d).moments
+    True
+    >>> c = s[1:, 2:]
+    >>> c.shape, c.i, c.j, c.v
+    ((2, 1), array([0]), array([0]), array([1]))
+    >>> all(s.percentile(q) == np.percentile(d, q)
+    ...     for q in (0, 50, 80, 90, 95, 100))
+    True
+    >>> c = s.clip(.5)
+    >>> c.v, FrameStats(c).moments == FrameStats(np.clip(d-.5, 0,
+    ...     None)).moments
+    (array([ 3.5,  0.5]), True)
+    """
+    def __init__(self, m, threshold=0):
+        m = np.asarray(m)
+        self.shape = m.shape
+        keep = m > threshold
+        self.i, self.j = np.nonzero(keep)
+        self.v = m[keep]
+        if threshold:
+            self.v = self.v-threshold
+
+    def __len__(self):
+        return self.v.shape[0]
+
+    def __getitem__(self, key):
+        (b, t, _), (l, r, _) = [k.indices(n) for k, n in
+                zip(key, self.shape)]
+        t, r = max(b, t), max(l, r)
+        keep = (self.i >= b) & (self.i < t) & (self.j >= l) & (self.j < r)
+        s = SparseFrame.__new__(SparseFrame)
+        s.shape = t-b, r-l
+        s.i, s.j, s.v = self.i[keep]-b, self.j[keep]-l, self.v[keep]
+        return s
+
+    def percentile(self, q):
+        """Percentile `q` (in percent) of the dense array, as
+        np.percentile() with linear interpolation."""
+        n = self.shape[0]*self.shape[1]
+        z = n-len(self) # zeros, ordered before the kept values
+        q = q/100.*(n-1)
+        k = int(np.floor(q))
+        t = q-k
+        # order statistics k and k+1
+        kv = np.array([k, min(k+1, n-1)])-z
+        a, b = 0, 0
+        if kv[1] >= 0:
+            v = np.partition(self.v, kv[kv >= 0])
+            a, b = np.where(kv >= 0, v[np.maximum(kv, 0)], 0)
+        # same lerp as np.percentile
+        d = b-a
+        return b-d*(1-t) if t >= .5 else a+d*t
+
+    def clip(self, black):
+        """`SparseFrame` of np.clip(m-black, 0, None) for the dense
+        array m, `black` >= 0."""
+        keep = self.v > black
+        s = SparseFrame.__new__(SparseFrame)
+        s.shape = self.shape
+        s.i, s.j, s.v = self.i[keep], self.j[keep], self.v[keep]-black
+        return s
+
+    def _projections(self):
+        # column sums, row sums, first x moment of each row
+        acc = _accumulator(self.v)
+        return (np.bincount(self.j, self.v, self.shape[1]).astype(acc),
+                np.bincount(self.i, self.v, self.shape[0]).astype(acc),
+                np.bincount(self.i, self.v*self.j, self.shape[0]))
+
+    def _angle_sum(self, angle, aspect, binsize):
+        a, b, km, n = _angle_coefficients(self.shape, angle, aspect,
+                binsize)
+        # first axis inverted, as in angle_sum()
+        k = a*self.j-b*(self.shape[0]-1-self.i)
+        k = np.floor(k-(km-.5)).astype(np.intp)
+        return np.bincount(k, self.v, n).astype(_accumulator(self.v))
+
+    def _polar_sum(self, center, direction, aspect, binsize, ellipse,
+            minlength):
+        k = _polar_index((self.i, self.j), center, direction, aspect,
+                binsize, ellipse)
+        if not minlength:
+            # the largest radius is at one of the corners
+            n, m = self.shape
+            minlength = int(_polar_index((np.array([0, 0, n-1, n-1]),
+                np.array([0, m-1, 0, m-1])), center, direction, aspect,
+                binsize, ellipse).max())+1
+        return np.bincount(k, self.v, minlength).astype(
+                _accumulator(self.v))
+
+
+def block_sum(m, f):
+    """Sum over non-overlapping `f` by `f` blocks.
+
+    Trailing rows and columns that do not fill a block are dropped.
+
+    Parameters
+    ----------
+    m : array_like, shape(N, M)
+        2D input array
+    f : int
+        Block size.
+
+    Returns
+    -------
+    out : ndarray, shape(N//f, M//f)
+
+    Examples
+    --------
+    >>> block_sum(np.arange(20).reshape(4, 5), 2)
+    array([[12, 20],
+           [52, 60]])
+    >>> block_sum(np.ones((4, 4), np.uint8)*255, 4)
+    array([[4080]])
+    """
+    m = np.asarray(m)
+    n, k = m.shape[0]//f*f, m.shape[1]//f*f
+    dtype = np.int64 if m.dtype.kind in "iub" else m.dtype
+    # strided adds are faster than reshape().sum()
+    r = m[0:n:f, :k].astype(dtype)
+    for i in range(1, f):
+        r += m[i:n:f, :k]
+    out = r[:, 0::f].copy()
+    for i in range(1, f):
+        out += r[:, i::f]
+    return out
+
+
+class Histogram(object):
+    """Value histogram of a non-negative integer image.
+
+    Percentiles are read from the cumulative histogram in O(maxval)
+    instead of partitioning the image. They are exact and identical to
+    `np.percentile` with linear interpolation.
+
+    Parameters
+    ----------
+    m : array_like, shape(N, M)
+        2D non-negative integer array
+    maxval : int
+        Largest expected value, sets the histogram length.
+    counts : ndarray, optional
+        Histogram of `m` if already known.
+
+    Attributes
+    ----------
+    counts : ndarray, shape(K)
+        Number of pixels with each value, K > maxval.
+    size : int
+        Number of pixels.
+
+    See also
+    --------
+    percentile : dispatches to `Histogram` or `np.percentile`
+
+    Examples
+    --------
+    >>> m = np.array([[0, 1, 2], [3, 9, 5], [6, 7, 8]])
+    >>> h = Histogram(m, 9)
+    >>> h.percentile(50) == np.percentile(m, 50)
+    True
+    >>> h.percentile([10, 95]) == np.percentile(m, [10, 95])
+    array([ True,  True], dtype=bool)
+    >>> h.percentile(50, black=4.5) == np.percentile(
+    ...     np.clip(m-4.5, 0, 9), 50)
+    True
+    >>> c = h.crop(1, 3, 1, 3)
+    >>> c.size, c.percentile(50) == np.percentile(m[1:3, 1:3], 50)
+    (4, True)
+    """
+    def __init__(self, m, maxval, counts=None):
+        self.m = m = np.asarray(m)
+        self.maxval = maxval
+        if counts is None:
+            counts = np.bincount(m.ravel(), minlength=maxval+1)
+        self.counts = counts
+        self.size = m.size
+        self._cumulative = None
+
+    @staticmethod
+    def applicable(m, maxval):
+        """Whether `m` can be histogrammed with length `maxval`+1."""
+        return (maxval is not None and maxval <= 0xffff and
+                (m.dtype.kind == "u" or
+                    (m.dtype.kind == "i" and m.min() >= 0)))
+
+    @property
+    def cumulative(self):
+        if self._cumulative is None:
+            self._cumulative = np.cumsum(self.counts)
+        return self._cumulative
+
+    def percentile(self, q, black=0):
+        """Percentile `q` (in percent) of np.clip(m-black, 0, maxval)."""
+        c = self.cumulative
+        q = np.true_divide(q, 100.)*(self.size-1)
+        k = np.floor(q)
+        t = q-k
+        # order statistics k and k+1, the clip is monotonic
+        a = np.searchsorted(c, k, side="right")
+        b = np.searchsorted(c, np.minimum(k+1, self.size-1), side="right")
+        a = np.clip(a-black, 0, self.maxval)
+        b = np.clip(b-black, 0, self.maxval)
+        # same lerp as np.percentile
+        d = b-a
+        return np.where(t >= .5, b-d*(1-t), a+d*t)[()]
+
+    def crop(self, bc, tc, lc, rc):
+        """Histogram of m[bc:tc, lc:rc], removing the margins from this
+        histogram if they are smaller than the remainder."""
+        m = self.m[bc:tc, lc:rc]
+        if 2*m.size < self.size:
+            return Histogram(m, self.maxval)
+        counts = self.counts.copy()
+        for e in (self.m[:bc], self.m[tc:],
+                self.m[bc:tc, :lc], self.m[bc:tc, rc:]):
+            if e.size:
+                d = np.bincount(e.ravel())
+                counts[:d.shape[0]] -= d
+        return Histogram(m, self.maxval, counts)
+
+
+def percentile(m, q, maxval=None):
+    """Percentile `q` (in percent) of `m`.
+
+    Uses a `Histogram` for non-negative integer data up to `maxval`
+    (at most 65535) and `np.percentile` otherwise.
+
+    Examples
+    --------
+    >>> m = np.arange(12).reshape(3, 4)
+    >>> percentile(m, 90, 11) == np.percentile(m, 90)
+    True
+    >>> percentile(m*.5, 90) == np.percentile(m*.5, 90)
+    True
+    """
+    m = np.asarray(m)
+    if Histogram.applicable(m, maxval):
+        return Histogram(m, maxval).percentile(q)
+    return np.percentile(m, q)
+
+
+def _benchmark(shape=(960, 1280), repeat=10):
+    import time
+    for dtype in np.uint8, np.uint16, np.int32, np.float32, np.double:
+        m = np.random.randint(0, 256, shape).astype(dtype)
+        for name, f in [
+                ("angle_sum", lambda: angle_sum(m, .3)),
+                ("angle_sums", lambda: angle_sums(m, (.3, .3+np.pi/2))),
+                ("polar_sum", lambda: polar_sum(m, np.array(shape)/2.,
+                    "azimuthal")),
+                ("FrameStats", lambda: FrameStats(m))]:
+            t = time.time()
+            for i in range(repeat):
+                f()
+            t = (time.time()-t)/repeat
+            print("%10s %10s %8.2f ms %8.1f Mpx/s" % (
+                np.dtype(dtype).name, name, t*1e3, m.size/t/1e6))
+
+
 if __name__ == "__main__":
-    import doctest
+    import doctest, sys
     doctest.testmod()
+    if "bench" in sys.argv[1:]:
+        _benchmark()
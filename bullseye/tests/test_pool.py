@@ -0,0 +1,107 @@
+#   bullseye - ccd laser beam profilers (pydc1394 + chaco)
+#   Copyright (C) 2012 Robert Jordens <robert@joerdens.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from threading import Event
+
+from ..pool import OrderedPool
+
+
+class OrderedPoolTest(unittest.TestCase):
+    def test_in_order(self):
+        # the first item finishes last
+        second = Event()
+        def func(i):
+            if i == 0:
+                second.wait()
+            elif i == 1:
+                second.set()
+            return i*10
+        pool = OrderedPool(func, workers=2, maxpending=8,
+                drop_oldest=False)
+        try:
+            for i in range(6):
+                pool.submit(i)
+            self.assertEqual(list(pool.results(block=True)),
+                    [0, 10, 20, 30, 40, 50])
+            self.assertEqual(len(pool), 0)
+            self.assertEqual(pool.dropped, 0)
+        finally:
+            pool.close()
+
+    def test_drop_oldest(self):
+        started, gate = Event(), Event()
+        def func(i):
+            started.set()
+            gate.wait()
+            return i
+        dropped = []
+        pool = OrderedPool(func, workers=1, maxpending=2,
+                drop=dropped.append)
+        try:
+            pool.submit(0)
+            started.wait() # 0 is running, the others wait
+            for i in range(1, 6):
+                pool.submit(i)
+            self.assertEqual(pool.dropped, 3)
+            self.assertEqual(dropped, [1, 2, 3])
+            gate.set()
+            self.assertEqual(list(pool.results(block=True)), [0, 4, 5])
+            self.assertEqual(pool.delivered, 6)
+        finally:
+            gate.set()
+            pool.close()
+
+    def test_close_drops_pending(self):
+        started, gate = Event(), Event()
+        def func(i):
+            started.set()
+            gate.wait()
+            return i
+        dropped = []
+        def drop(i):
+            dropped.append(i)
+            gate.set() # 0 finishes once 1 and 2 are dropped
+        pool = OrderedPool(func, workers=1, maxpending=4, drop=drop)
+        pool.submit(0)
+        started.wait()
+        pool.submit(1)
+        pool.submit(2)
+        pool.close()
+        self.assertEqual(dropped, [1, 2])
+        self.assertEqual(list(pool.results()), [0])
+
+    def test_exception(self):
+        def func(i):
+            if i == 1:
+                raise ValueError(i)
+            return i
+        pool = OrderedPool(func, workers=2, maxpending=4,
+                drop_oldest=False)
+        try:
+            for i in range(3):
+                pool.submit(i)
+            results = pool.results(block=True)
+            self.assertEqual(next(results), 0)
+            self.assertRaises(ValueError, next, results)
+            # the following results are still delivered
+            self.assertEqual(list(pool.results(block=True)), [2])
+        finally:
+            pool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
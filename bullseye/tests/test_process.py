@@ -0,0 +1,124 @@
+#   bullseye - ccd laser beam profilers (pydc1394 + chaco)
+#   Copyright (C) 2012 Robert Jordens <robert@joerdens.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import numpy as np
+
+from ..capture import DummyCapture
+from ..process import Process
+
+
+class AdaptiveTest(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.cam = DummyCapture(width=1280, height=960)
+        self.im = self.cam.dequeue()
+
+    def test_beam_left_window(self):
+        p = Process(capture=self.cam, background=.5, adaptive=True)
+        for i in range(3):
+            p.process(self.im)
+        self.assertEqual(p.iterations, 1) # warm start converged
+        x, a = p.x, p.a
+        # the previous crop is empty now: restart on the full frame
+        p.process(np.roll(self.im, 300, axis=1))
+        self.assertAlmostEqual(p.x, x+300, delta=1)
+        self.assertAlmostEqual(p.a, a, delta=.05*a)
+
+    def test_energy_radii(self):
+        p = Process(capture=self.cam, adaptive=True)
+        p.process(self.im)
+        self.assertTrue(np.all(np.isfinite(p.energy_radii)))
+        p.process(self.im)
+        self.assertEqual(p.iterations, 1)
+        # the crop would truncate the energy
+        self.assertTrue(np.all(np.isnan(p.energy_radii)))
+
+    def compare(self, frames, **kw):
+        p = Process(capture=self.cam, adaptive=True, **kw)
+        q = Process(capture=self.cam, **kw)
+        for im in frames:
+            p.process(im)
+            q.process(im)
+            self.assertAlmostEqual(p.x, q.x, delta=.05)
+            self.assertAlmostEqual(p.a, q.a, delta=.01*q.a)
+            self.assertAlmostEqual(p.b, q.b, delta=.01*q.b)
+
+    def test_drift(self):
+        self.compare([np.roll(self.im, 10*i, axis=1) for i in range(6)])
+
+    def gauss(self, sigma, x0=640.):
+        y, x = np.mgrid[:960, :1280]
+        return (200*np.exp(-((x-x0)**2+(y-480)**2)/(2*sigma**2))
+                ).astype(np.uint8)
+
+    def test_slow_drift(self):
+        self.compare([self.gauss(12, 640+.03*i) for i in range(20)])
+
+    def test_size_change(self):
+        self.compare([self.gauss(s) for s in np.linspace(10, 16, 8)])
+        self.compare([self.gauss(s) for s in np.linspace(12, 12.5, 20)])
+
+
+class BoundsTest(unittest.TestCase):
+    def test_frame_bounds(self):
+        np.random.seed(0)
+        cam = DummyCapture(width=1280, height=960)
+        im = cam.dequeue()
+        p = Process(capture=cam)
+        l, b, w, h = cam.bounds
+        x = p.analyze(im, bounds=(l, b, w, h))["beam"]["x"]
+        # the region changed after the frame was captured
+        cam.roi = [0, 0, 640, 480]
+        r = p.analyze(im, bounds=(l+100, b, w, h))
+        self.assertEqual(r["bounds"], (l+100, b, w, h))
+        self.assertAlmostEqual(r["beam"]["x"], x+100*cam.pixelsize)
+
+
+class RenderTest(unittest.TestCase):
+    def test_frame_not_shared(self):
+        # the frame goes back to the capture once the next is published
+        np.random.seed(0)
+        cam = DummyCapture(width=320, height=240)
+        im = cam.dequeue()
+        p = Process(capture=cam)
+        p.process(im)
+        self.assertFalse(np.shares_memory(p.render()["img"], im))
+        i, j, v = p.pixel(p.x, p.y)
+        self.assertEqual(v, im[j-cam.bounds[1], i-cam.bounds[0]])
+
+
+class SparseTest(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.cam = DummyCapture(width=1280, height=960)
+        self.im = self.cam.dequeue()
+
+    def test_same_as_dense(self):
+        for kw in (dict(background=.9, ignore=0), dict(background=.5),
+                dict(background=.5, pyramid=True)):
+            r = []
+            for sparse in False, True:
+                p = Process(capture=self.cam, sparse=sparse,
+                        sparse_fraction=1., **kw)
+                p.process(self.im)
+                r.append((p.x, p.y, p.a, p.b, p.black))
+            np.testing.assert_allclose(r[1], r[0], rtol=1e-9)
+
+
+if __name__ == "__main__":
+    unittest.main()
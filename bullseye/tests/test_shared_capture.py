@@ -0,0 +1,58 @@
+#   bullseye - ccd laser beam profilers (pydc1394 + chaco)
+#   Copyright (C) 2012 Robert Jordens <robert@joerdens.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest, functools
+
+import numpy as np
+
+from ..capture import DummyCapture
+from ..shared_capture import SharedCapture
+from ..process import Process
+
+
+class SharedCaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.cam = SharedCapture(functools.partial(DummyCapture,
+            width=320, height=240))
+
+    def tearDown(self):
+        self.cam.close()
+
+    def capture(self):
+        im = None
+        while im is None:
+            im = self.cam.capture()
+        return im
+
+    def test_zero_copy(self):
+        p = Process(capture=self.cam)
+        self.cam.start()
+        try:
+            for i in range(8):
+                im = self.capture()
+                self.assertTrue(np.shares_memory(im, self.cam.ring.frames))
+                p.process(im)
+                # the previous frame was released
+                self.assertEqual(len(self.cam._held), 1)
+        finally:
+            self.cam.stop()
+        self.cam.release(im)
+        self.assertEqual(len(self.cam._held), 0)
+        self.assertEqual(list(self.cam.ring.held), [0]*self.cam.slots)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+#   bullseye - ccd laser beam profilers (pydc1394 + chaco)
+#   Copyright (C) 2012 Robert Jordens <robert@joerdens.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest, tempfile, shutil, os
+from threading import Thread, Event
+
+import numpy as np
+
+from ..writer import FrameWriter
+
+
+class FrameWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.started, self.gate = Event(), Event()
+        self.saved, self.released = [], []
+
+    def gated_writer(self, **k):
+        # the first frame blocks the writer until the gate opens
+        w = FrameWriter(release=self.released.append, **k)
+        def save(name, im):
+            self.started.set()
+            self.gate.wait()
+            self.saved.append(name)
+        w.save = save
+        return w
+
+    def test_drop(self):
+        w = self.gated_writer(maxqueue=2, block=False)
+        try:
+            self.assertTrue(w.put("a", 0))
+            self.started.wait() # a is being written
+            self.assertTrue(w.put("b", 1))
+            self.assertTrue(w.put("c", 2))
+            self.assertFalse(w.put("d", 3))
+            self.assertFalse(w.put("e", 4))
+        finally:
+            self.gate.set()
+            w.close()
+        self.assertEqual((w.queued, w.written, w.dropped, w.errors),
+                (3, 3, 2, 0))
+        self.assertEqual(self.saved, ["a", "b", "c"])
+        self.assertEqual(self.released, [0, 1, 2])
+
+    def test_block(self):
+        w = self.gated_writer(maxqueue=1, block=True)
+        try:
+            w.put("a", 0)
+            self.started.wait()
+            w.put("b", 1)
+            t = Thread(target=w.put, args=("c", 2))
+            t.start()
+            t.join(.1)
+            self.assertTrue(t.is_alive()) # waits for space
+            self.assertEqual(w.queued, 2)
+        finally:
+            self.gate.set()
+        t.join()
+        w.close()
+        self.assertEqual((w.queued, w.written, w.dropped, w.errors),
+                (3, 3, 0, 0))
+        self.assertEqual(self.saved, ["a", "b", "c"])
+        self.assertEqual(self.released, [0, 1, 2])
+
+    def test_errors(self):
+        w = FrameWriter(release=self.released.append)
+        def save(name, im):
+            if name == "b":
+                raise IOError(name)
+            self.saved.append(name)
+        w.save = save
+        for i, n in enumerate("abc"):
+            w.put(n, i)
+        w.close()
+        self.assertEqual((w.queued, w.written, w.dropped, w.errors),
+                (3, 2, 0, 1))
+        self.assertEqual(self.saved, ["a", "c"])
+        self.assertEqual(self.released, [0, 1, 2])
+
+    def test_npy(self):
+        d = tempfile.mkdtemp()
+        try:
+            w = FrameWriter(codec="npy", block=True)
+            im = np.arange(12, dtype=np.uint16).reshape(3, 4)
+            name = os.path.join(d, "beam.npy")
+            w.put(name, im)
+            w.close()
+            self.assertEqual(w.written, 1)
+            np.testing.assert_array_equal(np.load(name), im)
+        finally:
+            shutil.rmtree(d)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+#   bullseye - ccd laser beam profilers (pydc1394 + chaco)
+#   Copyright (C) 2012 Robert Jordens <robert@joerdens.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import logging
+from collections import deque
+from threading import Thread, Condition
+
+
+class FrameWriter(object):
+    """Saves frames in a background thread.
+
+    At most `maxqueue` frames wait to be written. If the queue is full,
+    put() either drops the frame or blocks until there is space
+    (`block`). Codecs are "npz" (compressed, slow), "npz-stored"
+    (uncompressed npz) and "npy" (uncompressed, can be memory mapped).
+    `release(frame)` is called once a frame is written.
+    """
+    codecs = {
+            "npz": np.savez_compressed,
+            "npz-stored": np.savez,
+            "npy": np.save,
+            }
+
+    def __init__(self, codec="npz", maxqueue=16, block=False,
+            release=None):
+        self.save = self.codecs[codec]
+        self.maxqueue = maxqueue
+        self.block = block
+        self.release = release
+        self.cond = Condition()
+        self.pending = deque() # (name, frame)
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.closed = False
+        self.thread = Thread(target=self._work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, name, im):
+        """Queue `im` to be saved as `name`. Returns False if it was
+        dropped."""
+        with self.cond:
+            while len(self.pending) >= self.maxqueue:
+                if not self.block:
+                    self.dropped += 1
+                    return False
+                self.cond.wait()
+            self.pending.append((name, im))
+            self.queued += 1
+            self.cond.notify_all()
+        return True
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                name, im = self.pending.popleft()
+                self.cond.notify_all()
+            try:
+                self.save(name, im)
+                self.written += 1
+                logging.debug("saved as %s", name)
+            except Exception as e:
+                self.errors += 1
+                logging.warning("could not save %s: %s", name, e)
+            if self.release is not None:
+                self.release(im)
+
+    def close(self):
+        """Write the queued frames and stop."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        logging.debug("frames queued %i, written %i, dropped %i, "
+                "errors %i", self.queued, self.written, self.dropped,
+                self.errors)
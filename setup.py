@@ -49,6 +49,7 @@ setup(
         #test_suite = "bullseye.tests.test_all",
         entry_points = {
             "gui_scripts": ["bullseye = bullseye.app:main"],
+            "console_scripts": ["bullseye-cli = bullseye.cli:main"],
             },
         include_package_data = True,
         classifiers = [f.strip() for f in """